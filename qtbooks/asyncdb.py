@@ -0,0 +1,172 @@
+import threading
+from concurrent.futures import Executor, Future, ThreadPoolExecutor
+from typing import Any, Callable, List, Optional, Set, Tuple, TypeVar
+
+from PyQt5 import QtCore as qtc
+
+from qtbooks import config, model
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+OnDone = Optional[Callable[[Any], None]]
+OnError = Optional[Callable[[Exception], None]]
+
+
+class AsyncController(qtc.QObject):
+    """Runs the calls to a controller away from the UI thread
+
+    Reads run on a pool of `readers` threads, each with its own read-only
+    connection, and writes run one at a time, in the order they were requested, on
+    a writer thread with its own connection. Calls run for the user `controller`
+    has when they are requested. Every thread shares the cached results of
+    `controller`, and the commits of other processes are found by
+    check_external_changes, on the writer thread.
+
+    Every call returns a Future. Its result is also passed to `on_done`, or its
+    error to `on_error`, on the thread of the AsyncController, usually the UI one.
+    """
+
+    # Emitted with the ids of the books modified by each write
+    books_changed = qtc.pyqtSignal(object)
+    _finished = qtc.pyqtSignal(object, object, object)
+
+    def __init__(self, controller: model.Controller, readers: int = 2) -> None:
+        super().__init__()
+        self.controller = controller
+        self.local = threading.local()
+        self.read_pool = ThreadPoolExecutor(readers, thread_name_prefix="reader")
+        self.write_pool = ThreadPoolExecutor(1, thread_name_prefix="writer")
+        self._finished.connect(self._deliver)
+        # Opened now, so check_external_changes sees the commits from the start
+        self.write_pool.submit(self._thread_controller, controller.readonly)
+
+    def _thread_controller(self, readonly: bool) -> model.Controller:
+        # Connections can only be used by the thread that opened them
+        if (controller := getattr(self.local, "controller", None)) is None:
+            controller = model.Controller(
+                self.controller.fn,
+                readonly=readonly,
+                wal=self.controller.wal,
+                shared=self.controller,
+            )
+            if not readonly:
+                controller.add_listener(self.books_changed.emit)
+            self.local.controller = controller
+        return controller
+
+    def _submit(
+        self,
+        pool: Executor,
+        readonly: bool,
+        call: Callable[[model.Controller], T],
+        on_done: OnDone,
+        on_error: OnError,
+    ) -> "Future[T]":
+        user = self.controller.user
+
+        def run() -> T:
+            controller = self._thread_controller(readonly)
+            controller.set_user(user)
+            return call(controller)
+
+        future = pool.submit(run)
+        future.add_done_callback(lambda f: self._finished.emit(f, on_done, on_error))
+        return future
+
+    def _deliver(self, future: Future, on_done: OnDone, on_error: OnError) -> None:
+        if future.cancelled():
+            return
+        if (error := future.exception()) is not None:
+            if on_error is not None:
+                on_error(error)
+            else:
+                logger.error(f"Database call failed: {error}", exc_info=error)
+        elif on_done is not None:
+            on_done(future.result())
+
+    def read(
+        self,
+        call: Callable[[model.Controller], T],
+        on_done: OnDone = None,
+        on_error: OnError = None,
+    ) -> "Future[T]":
+        """Runs `call` with a read-only controller"""
+        return self._submit(self.read_pool, True, call, on_done, on_error)
+
+    def write(
+        self,
+        call: Callable[[model.Controller], T],
+        on_done: OnDone = None,
+        on_error: OnError = None,
+    ) -> "Future[T]":
+        """Runs `call` with the controller of the writer thread"""
+        if self.controller.readonly:
+            raise ValueError("Can't write to a readonly database")
+        return self._submit(self.write_pool, False, call, on_done, on_error)
+
+    def get_view(
+        self, view: config.View, on_done: OnDone = None, on_error: OnError = None
+    ) -> "Future[Tuple[List[model.Row], List[str]]]":
+        return self.read(lambda c: c.get_view(view), on_done, on_error)
+
+    def get_view_books(
+        self,
+        view: config.View,
+        ids: Set[int],
+        on_done: OnDone = None,
+        on_error: OnError = None,
+    ) -> "Future[List[model.Row]]":
+        return self.read(lambda c: c.get_view_books(view, ids), on_done, on_error)
+
+    def get_book(
+        self, id: int, on_done: OnDone = None, on_error: OnError = None
+    ) -> "Future[model.Book]":
+        return self.read(lambda c: c.get_book(id), on_done, on_error)
+
+    def get_entity_names(
+        self, on_done: OnDone = None, on_error: OnError = None
+    ) -> "Future[Tuple[List[str], List[str], List[str]]]":
+        """Names of every author, genre and publisher, loading them to resolve names
+        without querying the database"""
+
+        def call(c: model.Controller) -> Tuple[List[str], List[str], List[str]]:
+            c.load_entities()
+            return c.get_all_authors(), c.get_all_genres(), c.get_all_publishers()
+
+        return self.read(call, on_done, on_error)
+
+    def add_book(
+        self, book: model.Book, on_done: OnDone = None, on_error: OnError = None
+    ) -> "Future[None]":
+        return self.write(lambda c: c.add_book(book), on_done, on_error)
+
+    def update_book(
+        self, book: model.Book, on_done: OnDone = None, on_error: OnError = None
+    ) -> "Future[None]":
+        return self.write(lambda c: c.update_book(book), on_done, on_error)
+
+    def delete_book(
+        self, book: model.Book, on_done: OnDone = None, on_error: OnError = None
+    ) -> "Future[None]":
+        return self.write(lambda c: c.delete_book(book), on_done, on_error)
+
+    def check_external_changes(
+        self, on_done: OnDone = None, on_error: OnError = None
+    ) -> "Future[bool]":
+        """Whether other processes committed since the last check, dropping the
+        cached results if so"""
+        return self._submit(
+            self.write_pool,
+            self.controller.readonly,
+            lambda c: c.check_external_changes(),
+            on_done,
+            on_error,
+        )
+
+    def shutdown(self) -> None:
+        """Drops the pending reads and waits for the pending writes"""
+        self.read_pool.shutdown(cancel_futures=True)
+        self.write_pool.shutdown()
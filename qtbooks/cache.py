@@ -0,0 +1,150 @@
+import functools
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, Iterable, Optional, Tuple
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Generation of the whole cache, and of each dependency
+Snapshot = Tuple[int, Tuple[Tuple[Hashable, int], ...]]
+
+
+class TableCache(object):
+    """LRU cache whose entries are invalidated through their dependencies
+
+    Dependencies are any hashable, usually table names. Each one has a generation
+    counter that is bumped when it is invalidated, and an entry is only valid while
+    the generations of all its dependencies are the ones it was computed with.
+    The total weight of the entries is kept under `max_weight`.
+
+    If given, `stamp` is called on every lookup, and the whole cache is dropped
+    when it returns a different value, for changes no dependency can track.
+    Safe to share between threads.
+    """
+
+    def __init__(
+        self, max_weight: int, stamp: Optional[Callable[[], Hashable]] = None
+    ) -> None:
+        self.max_weight = max_weight
+        self.stamp = stamp
+        self.last_stamp = None if stamp is None else stamp()
+        self.weight = 0
+        # Bumped when the cache is cleared, so results computed before aren't stored
+        self.epoch = 0
+        self.generations: Dict[Hashable, int] = {}
+        self.entries: "OrderedDict[Hashable, Tuple[Snapshot, int, Any]]" = OrderedDict()
+        self.lock = threading.RLock()
+
+    def snapshot(self, deps: Iterable[Hashable]) -> Snapshot:
+        with self.lock:
+            return self.epoch, tuple(
+                (dep, self.generations.get(dep, 0)) for dep in deps
+            )
+
+    def get(self, key: Hashable) -> Tuple[bool, Any]:
+        with self.lock:
+            if self.stamp is not None and (stamp := self.stamp()) != self.last_stamp:
+                logger.debug("Cache stamp changed, dropping every entry")
+                self.last_stamp = stamp
+                self.clear()
+            if (entry := self.entries.get(key)) is None:
+                return False, None
+            (_, gens), weight, value = entry
+            if any(self.generations.get(dep, 0) != gen for dep, gen in gens):
+                self._remove(key)
+                return False, None
+            self.entries.move_to_end(key)
+            return True, value
+
+    def put(
+        self,
+        key: Hashable,
+        snapshot: Snapshot,
+        value: Any,
+        weight: int = 1,
+    ) -> None:
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+            if weight > self.max_weight or snapshot[0] != self.epoch:
+                return
+            self.entries[key] = (snapshot, weight, value)
+            self.weight += weight
+            while self.weight > self.max_weight:
+                self._remove(next(iter(self.entries)))
+
+    def invalidate(self, *deps: Hashable) -> None:
+        with self.lock:
+            for dep in deps:
+                self.generations[dep] = self.generations.get(dep, 0) + 1
+
+    def clear(self) -> None:
+        with self.lock:
+            self.entries.clear()
+            self.weight = 0
+            self.epoch += 1
+
+    def _remove(self, key: Hashable) -> None:
+        self.weight -= self.entries.pop(key)[1]
+
+
+def cached(
+    deps: Callable[..., Iterable[Hashable]],
+    weight: Callable[[Any], int] = lambda value: 1,
+) -> Callable:
+    """Caches a method in the TableCache of its instance, `self.cache`
+
+    `deps` receives the same arguments as the method and returns the dependencies
+    of the result, and `weight` receives the result.
+    """
+
+    def decorator(method: Callable) -> Callable:
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            key = (method.__name__, args, tuple(sorted(kwargs.items())))
+            hit, value = self.cache.get(key)
+            if hit:
+                return value
+            snapshot = self.cache.snapshot(deps(self, *args, **kwargs))
+            value = method(self, *args, **kwargs)
+            self.cache.put(key, snapshot, value, weight(value))
+            return value
+
+        return wrapper
+
+    return decorator
+
+
+def test_invalidate() -> None:
+    cache = TableCache(max_weight=10)
+    cache.put("books", cache.snapshot(["Books"]), 1)
+    cache.put("authors", cache.snapshot(["Authors", "BookAuthors"]), 2)
+    cache.put("both", cache.snapshot(["Books", "BookAuthors"]), 3)
+    cache.invalidate("BookAuthors")
+    assert cache.get("books") == (True, 1)
+    assert cache.get("authors") == (False, None)
+    assert cache.get("both") == (False, None)
+    assert cache.weight == 1
+
+    # Computed before the invalidation, so possibly from the previous data
+    snapshot = cache.snapshot(["Books"])
+    cache.invalidate("Books")
+    cache.put("books", snapshot, 4)
+    assert cache.get("books") == (False, None)
+
+
+def test_clear() -> None:
+    cache = TableCache(max_weight=10)
+    cache.put("books", cache.snapshot(["Books"]), 1)
+    snapshot = cache.snapshot(["Books"])
+    cache.clear()
+    assert cache.get("books") == (False, None)
+    # No dependency changed, but the result predates the clear
+    cache.put("books", snapshot, 2)
+    assert cache.get("books") == (False, None)
+    assert cache.weight == 0
+
+    cache.put("books", cache.snapshot(["Books"]), 3)
+    assert cache.get("books") == (True, 3)
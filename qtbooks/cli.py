@@ -1,6 +1,9 @@
+import csv
+import sys
+
 import click
 
-from qtbooks import gui, model
+from qtbooks import gui, model, config
 
 
 @click.group()
@@ -24,5 +27,54 @@ def qtgui(ctx) -> None:
     gui.main(ctx.obj)
 
 
+@cli.command(name="list")
+@click.argument("view_name")
+@click.argument("exp", default="")
+@click.pass_context
+def list_view(ctx, view_name: str, exp: str) -> None:
+    """Print the rows of a view matching the filter EXP as tab separated values"""
+    options = config.parse_config(ctx.obj)
+    view = next((v for v in options.views if v.name == view_name), None)
+    if view is None:
+        raise click.BadParameter(f"No view named {view_name}")
+    controller = model.Controller(options.db_file, options.lockfile)
+    try:
+        if options.user.lower() not in controller.get_all_readers():
+            raise click.BadParameter(f"No user named {options.user}")
+        controller.change_user(options.user)
+        rows, header = controller.get_view(view, exp)
+    finally:
+        controller.release_lock()
+
+    writer = csv.writer(sys.stdout, delimiter="\t")
+    writer.writerow(header)
+    writer.writerows(rows)
+
+
+@cli.command()
+@click.option("--disable", is_flag=True, help="Go back to the plain BooksView")
+@click.pass_context
+def materialize(ctx, disable: bool) -> None:
+    """Keep a trigger maintained copy of BooksView in the database"""
+    options = config.parse_config(ctx.obj)
+    controller = model.Controller(options.db_file, options.lockfile)
+    try:
+        controller.materialize_books_view(not disable)
+    finally:
+        controller.release_lock()
+
+
+@cli.command()
+@click.pass_context
+def rebuild_index(ctx) -> None:
+    """Rebuild the full text search index of the database"""
+    options = config.parse_config(ctx.obj)
+    controller = model.Controller(options.db_file, options.lockfile)
+    try:
+        controller.rebuild_search_index()
+    finally:
+        controller.release_lock()
+
+
 if __name__ == "__main__":
     cli(obj={})
@@ -37,10 +37,14 @@ class Options(object):
     db_file: str = "./qtbooks.sqlite"
     views: List[View] = attr.ib(factory=list)
     verbose: bool = False
+    warm_up: bool = False
+    lockfile: bool = False
 
     def update(self, d: dict) -> None:
         for k, v in d.items():
             if hasattr(self, k) and v is not None:
+                if isinstance(getattr(self, k), bool) and isinstance(v, str):
+                    v = v.lower() in ("1", "yes", "true", "on")
                 setattr(self, k, v)
 
 
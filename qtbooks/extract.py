@@ -1,57 +1,129 @@
 import datetime
 import locale
 import re
-from typing import Iterator
+from pathlib import Path
+from typing import Iterable, Iterator, Optional, Tuple, Union
 import logging
 
+import attr
+from lxml import etree
+
 from qtbooks import model
-import requests
+from qtbooks.fetch import Fetcher, FetchError
+from qtbooks.pagecache import PageCache
 from bs4 import BeautifulSoup
-from requests.compat import urljoin
 
 logger = logging.getLogger(__name__)
 
-HEADERS = {
-    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/74.0.3729.169 Safari/537.36"
-}
+_fetcher: Optional[Fetcher] = None
+
+
+class BookExists(ValueError):
+    pass
+
+
+def default_fetcher() -> Fetcher:
+    global _fetcher
+    if _fetcher is None:
+        _fetcher = Fetcher(cache=PageCache())
+    return _fetcher
+
+
+def _has_isbn(text: str) -> bool:
+    return "books:isbn" in text
 
 
-def import_book(url: str, controller: model.Controller) -> model.Book:
-    max_attempts = 3
-    for i in range(max_attempts):
+def import_book(
+    url: str, controller: model.Controller, fetcher: Optional[Fetcher] = None
+) -> model.Book:
+    text = (fetcher or default_fetcher()).fetch(url, _has_isbn)
+    return parse_book(text, url, controller)
+
+
+def import_books(
+    urls: Iterable[str], controller: model.Controller, fetcher: Optional[Fetcher] = None
+) -> Iterator[Tuple[str, Union[model.Book, Exception]]]:
+    """Imports the books at `urls`, yielding (url, book or error) as they're ready
+
+    Pages are fetched concurrently, while parsing and database lookups happen in
+    the calling thread. A FetchError, a ConnectionError, is yielded for pages that
+    couldn't be obtained.
+    """
+    for url, info in import_pages(urls, fetcher):
+        if isinstance(info, Exception):
+            yield url, info
+            continue
         try:
-            text = requests.get(url, headers=HEADERS).text
-            bs = BeautifulSoup(text, "lxml")
-            isbn = bs.find(property="books:isbn")["content"]
-            if isbn.lower() == "null":
-                isbn = None
-            break
+            yield url, make_book(info, url, controller)
         except Exception as e:
-            logger.warning(
-                f"Failed to obtain goodreads page, attempt {i+1}/{max_attempts}"
-            )
-            if i == max_attempts - 1:
-                raise ConnectionError(f"URL {url} did not yield an ISBN")
-
-    title = bs.find(id="bookTitle", itemprop="name").text.lstrip().rstrip()
-    pub_tag = bs.find(text=re.compile("Published"))
-    if pub_tag is not None and (match := re.search(r"-?\d\d\d\d", pub_tag)) is not None:
-        pub_year = int(match.group())
-    else:
-        pub_year = 0
+            yield url, e
 
-    if pub_tag is not None and (match := re.search(r"by (.*)\n", pub_tag)) is not None:
-        publisher = match.group(1)
-    else:
-        publisher = None
 
-    first_pub_tag = bs.find(text=re.compile("first published"))
-    if (
-        first_pub_tag is not None
-        and (match := re.search(r"-?\d\d\d\d", first_pub_tag)) is not None
-    ):
-        pub_year = int(match.group())
+def import_pages(
+    urls: Iterable[str], fetcher: Optional[Fetcher] = None
+) -> Iterator[Tuple[str, Union["PageInfo", Exception]]]:
+    """Fetches and parses the pages at `urls`, yielding (url, page info or error)
+    as they're ready"""
+    fetcher = fetcher or default_fetcher()
+    for url, text in fetcher.fetch_all(urls, _has_isbn):
+        if isinstance(text, FetchError):
+            yield url, text
+            continue
+        try:
+            yield url, parse_page(text, url)
+        except Exception as e:
+            yield url, e
+
+
+@attr.s(auto_attribs=True, frozen=True)
+class PageInfo(object):
+    """Book data found in a goodreads page"""
+
+    isbn: Optional[str]
+    title: str
+    pub_year: int
+    publisher: Optional[str]
+    authors: Tuple[str, ...] = attr.ib(converter=tuple)
+    genres: Tuple[str, ...] = attr.ib(converter=tuple)
+
+
+def _pub_info(
+    pub_text: Optional[str], first_pub_text: Optional[str]
+) -> Tuple[int, Optional[str]]:
+    pub_year = 0
+    publisher = None
+    if pub_text is not None:
+        if (match := re.search(r"-?\d\d\d\d", pub_text)) is not None:
+            pub_year = int(match.group())
+        if (match := re.search(r"by (.*)\n", pub_text)) is not None:
+            publisher = match.group(1)
+    if first_pub_text is not None:
+        if (match := re.search(r"-?\d\d\d\d", first_pub_text)) is not None:
+            pub_year = int(match.group())
+
+    return pub_year, publisher
 
+
+def parse_page_soup(text: str, url: str = "") -> PageInfo:
+    """Parses a goodreads page building the full BeautifulSoup tree
+
+    Reference implementation for parse_page, which should give the same results.
+    """
+    bs = BeautifulSoup(text, "lxml")
+    try:
+        isbn = bs.find(property="books:isbn")["content"]
+    except Exception:
+        raise ConnectionError(f"URL {url} did not yield an ISBN")
+    if isbn.lower() == "null":
+        isbn = None
+
+    if (title_tag := bs.find(id="bookTitle", itemprop="name")) is None:
+        raise ValueError(f"URL {url} has no book title")
+    title = title_tag.text.lstrip().rstrip()
+    pub_year, publisher = _pub_info(
+        bs.find(text=re.compile("Published")),
+        bs.find(text=re.compile("first published")),
+    )
     authors = [tag.text for tag in bs.find(id="bookAuthors").find_all(itemprop="name")]
     genres_list = list(
         dict.fromkeys(
@@ -59,6 +131,68 @@ def import_book(url: str, controller: model.Controller) -> model.Book:
         )
     )
 
+    return PageInfo(isbn, title, pub_year, publisher, authors, genres_list)
+
+
+_ISBN = etree.XPath("//meta[@property = 'books:isbn']/@content")
+_TITLE = etree.XPath("//*[@id = 'bookTitle'][@itemprop = 'name']")
+_PUBLISHED = etree.XPath(
+    "//text()[contains(., 'Published')] | //comment()[contains(., 'Published')]"
+)
+_FIRST_PUBLISHED = etree.XPath(
+    "//text()[contains(., 'first published')]"
+    " | //comment()[contains(., 'first published')]"
+)
+_AUTHORS = etree.XPath("(//*[@id = 'bookAuthors'])[1]//*[@itemprop = 'name']")
+_GENRES = etree.XPath(
+    "//a[contains(concat(' ', normalize-space(@class), ' '), ' bookPageGenreLink ')]"
+)
+
+
+def _first_text(xpath: etree.XPath, root) -> Optional[str]:
+    nodes = xpath(root)
+    if len(nodes) == 0:
+        return None
+    node = nodes[0]
+    return node.text if isinstance(node, etree._Comment) else str(node)
+
+
+def parse_page(text: str, url: str = "") -> PageInfo:
+    """Parses a goodreads page, evaluating only the XPaths of the needed fields"""
+    root = etree.HTML(text)
+    isbns = _ISBN(root)
+    if len(isbns) == 0:
+        raise ConnectionError(f"URL {url} did not yield an ISBN")
+    isbn = isbns[0] if isbns[0].lower() != "null" else None
+
+    if len(title_tags := _TITLE(root)) == 0:
+        raise ValueError(f"URL {url} has no book title")
+    title = etree.tostring(
+        title_tags[0], method="text", encoding="unicode", with_tail=False
+    ).strip()
+    pub_year, publisher = _pub_info(
+        _first_text(_PUBLISHED, root), _first_text(_FIRST_PUBLISHED, root)
+    )
+    authors = [
+        etree.tostring(tag, method="text", encoding="unicode", with_tail=False)
+        for tag in _AUTHORS(root)
+    ]
+    genres_list = list(
+        dict.fromkeys(
+            etree.tostring(tag, method="text", encoding="unicode", with_tail=False)
+            for tag in _GENRES(root)
+        )
+    )
+
+    return PageInfo(isbn, title, pub_year, publisher, authors, genres_list)
+
+
+def parse_book(text: str, url: str, controller: model.Controller) -> model.Book:
+    return make_book(parse_page(text, url), url, controller)
+
+
+def make_book(info: PageInfo, url: str, controller: model.Controller) -> model.Book:
+    isbn, title, authors = info.isbn, info.title, info.authors
     already_exists = False
     if isbn is None:
         books = controller.get_books_title(title)
@@ -75,17 +209,41 @@ def import_book(url: str, controller: model.Controller) -> model.Book:
             already_exists = True
 
     if already_exists:
-        raise ValueError(f"Book at {url} already exists in the database")
+        raise BookExists(f"Book at {url} already exists in the database")
 
-    book = model.Book(None, title, pub_year, 0, datetime.date.today(), "", isbn)
-    book.authors = [
-        controller.get_or_make_book_author(book, author) for author in authors
-    ]
-    book.genres = [
-        controller.get_or_make_book_genre(book, genre) for genre in genres_list
-    ]
+    book = model.Book(None, title, info.pub_year, 0, datetime.date.today(), "", isbn)
+    book.authors = controller.make_book_authors(book, authors)
+    book.genres = controller.make_book_genres(book, info.genres)
     # FIXME multiple publishers?
-    if publisher is not None:
-        book.publishers = [controller.get_or_make_book_publisher(book, publisher)]
+    if info.publisher is not None:
+        book.publishers = controller.make_book_publishers(book, [info.publisher])
 
     return book
+
+
+# Trimmed goodreads pages covering the edge cases of the parsers
+TEST_PAGES = Path(__file__).parent / "testdata" / "goodreads"
+
+
+def _parse_or_error(parse, text: str):
+    try:
+        return parse(text)
+    except Exception as e:
+        return type(e)
+
+
+def test_parse_page() -> None:
+    pages = {fn.stem: fn.read_text() for fn in TEST_PAGES.glob("*.html")}
+    assert len(pages) > 0
+    for name, text in pages.items():
+        expected = _parse_or_error(parse_page_soup, text)
+        assert _parse_or_error(parse_page, text) == expected, name
+
+    assert _parse_or_error(parse_page, pages["missing_isbn"]) is ConnectionError
+    info = parse_page(pages["null_isbn"])
+    assert info.isbn is None and info.publisher is None
+    assert info.authors == ("Jorge Luis Borges", "Anthony Kerrigan")
+    info = parse_page(pages["series"])
+    assert info.title == "The Fellowship of the Ring"
+    assert info.pub_year == 1954
+    assert info.genres == ("Fantasy", "Classics", "High Fantasy")
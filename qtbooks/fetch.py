@@ -0,0 +1,221 @@
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Callable, Dict, Iterable, Iterator, Optional, Tuple, Union
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from qtbooks.pagecache import PageCache
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+HEADERS = {
+    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/74.0.3729.169 Safari/537.36"
+}
+
+# Responses worth retrying, the rest of the errors are final
+RETRY_STATUS = {429, 500, 502, 503, 504}
+
+
+class FetchError(ConnectionError):
+    pass
+
+
+class _HostLimiter(object):
+    """Limits the concurrent requests to a host and the rate at which they start"""
+
+    def __init__(self, concurrency: int, min_interval: float) -> None:
+        self.semaphore = threading.BoundedSemaphore(concurrency)
+        self.min_interval = min_interval
+        self.lock = threading.Lock()
+        self.next_start = 0.0
+
+    def __enter__(self) -> None:
+        self.semaphore.acquire()
+        with self.lock:
+            now = time.monotonic()
+            start = max(now, self.next_start)
+            self.next_start = start + self.min_interval
+        time.sleep(start - now)
+
+    def __exit__(self, *exc) -> None:
+        self.semaphore.release()
+
+
+class Fetcher(object):
+    """Fetches pages concurrently over pooled keep-alive connections
+
+    At most `per_host` requests run at once against the same host, starting at
+    least `min_interval` seconds apart. Failed requests are retried up to
+    `max_attempts` times with exponential backoff and full jitter. `timeout` is
+    passed to requests as the (connect, read) timeouts.
+
+    Pages are read from and saved to `cache` if given. An `offline` fetcher only
+    returns cached pages, no matter how old.
+    """
+
+    def __init__(
+        self,
+        max_workers: int = 8,
+        per_host: int = 4,
+        min_interval: float = 0.2,
+        timeout: Tuple[float, float] = (5, 30),
+        max_attempts: int = 3,
+        backoff: float = 1.0,
+        cache: Optional[PageCache] = None,
+        offline: bool = False,
+    ) -> None:
+        self.max_workers = max_workers
+        self.per_host = per_host
+        self.min_interval = min_interval
+        self.timeout = timeout
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.cache = cache
+        self.offline = offline
+        self.session = requests.Session()
+        self.session.headers.update(HEADERS)
+        adapter = HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.hosts: Dict[str, _HostLimiter] = {}
+        self.lock = threading.Lock()
+
+    def _host_limiter(self, url: str) -> _HostLimiter:
+        host = urlsplit(url).netloc
+        with self.lock:
+            if host not in self.hosts:
+                self.hosts[host] = _HostLimiter(self.per_host, self.min_interval)
+            return self.hosts[host]
+
+    def fetch(self, url: str, validate: Optional[Callable[[str], bool]] = None) -> str:
+        """Text of the page at `url`
+
+        A page rejected by `validate` is retried like a failed request. Raises
+        FetchError when every attempt fails.
+        """
+        if self.cache is not None:
+            text = self.cache.get(url, any_age=self.offline)
+            if text is not None and (validate is None or validate(text)):
+                return text
+        if self.offline:
+            raise FetchError(f"Page {url} is not cached")
+
+        limiter = self._host_limiter(url)
+        for i in range(self.max_attempts):
+            try:
+                with limiter:
+                    response = self.session.get(url, timeout=self.timeout)
+                if response.status_code in RETRY_STATUS:
+                    raise FetchError(f"HTTP {response.status_code}")
+                response.raise_for_status()
+                if validate is not None and not validate(response.text):
+                    raise FetchError("Invalid page")
+                if self.cache is not None:
+                    self.cache.put(url, response.text)
+                return response.text
+            except requests.HTTPError as e:
+                raise FetchError(f"Failed to obtain {url}: {e}") from e
+            except (requests.RequestException, FetchError) as e:
+                logger.warning(
+                    f"Failed to obtain {url}, attempt {i+1}/{self.max_attempts}: {e}"
+                )
+                if i == self.max_attempts - 1:
+                    raise FetchError(f"Failed to obtain {url}: {e}") from e
+                time.sleep(random.uniform(0, self.backoff * 2**i))
+        raise AssertionError("unreachable")
+
+    def fetch_all(
+        self, urls: Iterable[str], validate: Optional[Callable[[str], bool]] = None
+    ) -> Iterator[Tuple[str, Union[str, FetchError]]]:
+        """Fetches all `urls` concurrently, yielding (url, text or error) as they
+        complete"""
+        with ThreadPoolExecutor(self.max_workers) as executor:
+            futures = {executor.submit(self.fetch, url, validate): url for url in urls}
+            try:
+                for future in as_completed(futures):
+                    try:
+                        yield futures[future], future.result()
+                    except FetchError as e:
+                        yield futures[future], e
+            finally:
+                for future in futures:
+                    future.cancel()
+
+
+class _TestHandler(BaseHTTPRequestHandler):
+    """Serves /flaky failing twice with 503, /missing with 404 and /slow/* slowly,
+    counting the requests to each path and the most /slow ones at once"""
+
+    hits: Dict[str, int] = {}
+    running = 0
+    max_running = 0
+    lock = threading.Lock()
+
+    def do_GET(self) -> None:
+        cls = self.__class__
+        with cls.lock:
+            cls.hits[self.path] = hits = cls.hits.get(self.path, 0) + 1
+        if self.path == "/missing" or (self.path == "/flaky" and hits <= 2):
+            self.send_response(404 if self.path == "/missing" else 503)
+            self.end_headers()
+            return
+        if self.path.startswith("/slow"):
+            with cls.lock:
+                cls.running += 1
+                cls.max_running = max(cls.max_running, cls.running)
+            time.sleep(0.1)
+            with cls.lock:
+                cls.running -= 1
+        body = f"page {self.path}".encode()
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args) -> None:
+        pass
+
+
+def test_fetcher(tmp_path: Path) -> None:
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _TestHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_port}"
+    cache = PageCache(tmp_path / "pages.sqlite")
+    fetcher = Fetcher(per_host=2, min_interval=0, backoff=0.01, cache=cache)
+    try:
+        assert fetcher.fetch(f"{url}/flaky") == "page /flaky"
+        assert _TestHandler.hits["/flaky"] == 3
+
+        try:
+            fetcher.fetch(f"{url}/missing")
+        except FetchError:
+            pass
+        else:
+            raise AssertionError("404 didn't fail")
+        assert _TestHandler.hits["/missing"] == 1
+
+        results = dict(fetcher.fetch_all(f"{url}/slow/{i}" for i in range(8)))
+        assert results == {f"{url}/slow/{i}": f"page /slow/{i}" for i in range(8)}
+        assert _TestHandler.max_running == 2
+
+        offline = Fetcher(cache=cache, offline=True)
+        assert offline.fetch(f"{url}/slow/0") == "page /slow/0"
+        assert _TestHandler.hits["/slow/0"] == 1
+        try:
+            offline.fetch(f"{url}/other")
+        except FetchError:
+            pass
+        else:
+            raise AssertionError("Uncached page fetched offline")
+        assert "/other" not in _TestHandler.hits
+    finally:
+        server.shutdown()
+        server.server_close()
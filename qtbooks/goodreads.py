@@ -0,0 +1,412 @@
+import csv
+import datetime
+import json
+import re
+import time
+from typing import (
+    Callable,
+    Dict,
+    Hashable,
+    Iterator,
+    List,
+    Optional,
+    Set,
+    Tuple,
+    Union,
+)
+
+import attr
+
+from qtbooks import model, extract
+from qtbooks.fetch import Fetcher
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+Entry = Dict[str, str]
+
+# Status of each library entry in the checkpoint table
+PENDING = "pending"
+DONE = "done"
+EXISTS = "exists"
+FETCH_FAILED = "fetch_failed"
+FAILED = "failed"
+
+
+def read_library(fn: str) -> Tuple[List[str], List[Entry]]:
+    """Header and entries of a goodreads library export"""
+    with open(fn, newline="") as f:
+        library = list(csv.reader(f, delimiter=","))
+    return library[0], [dict(zip(library[0], row)) for row in library[1:]]
+
+
+def book_url(entry: Entry) -> str:
+    return f"https://goodreads.com/book/show/{entry['Book Id']}"
+
+
+def _parse_date(date: str) -> datetime.date:
+    return datetime.datetime.strptime(date, "%Y/%m/%d").date()
+
+
+def _isbn(value: str) -> Optional[str]:
+    # Exported as ="0123456789" so spreadsheets keep the leading zeros
+    return re.sub(r"[^0-9Xx]", "", value) or None
+
+
+def _int(value: str) -> int:
+    try:
+        return int(value)
+    except ValueError:
+        return 0
+
+
+def page_info(entry: Entry) -> extract.PageInfo:
+    """Book data in the columns of `entry`, without genres, which goodreads
+    doesn't export"""
+    authors = [entry["Author"]] + [
+        author.strip()
+        for author in entry.get("Additional Authors", "").split(",")
+        if author.strip()
+    ]
+    return extract.PageInfo(
+        isbn=_isbn(entry.get("ISBN13", "")) or _isbn(entry.get("ISBN", "")),
+        title=entry["Title"].strip(),
+        pub_year=_int(entry.get("Original Publication Year", ""))
+        or _int(entry.get("Year Published", "")),
+        publisher=entry.get("Publisher") or None,
+        authors=[author for author in authors if author],
+        genres=[],
+    )
+
+
+def book_from_entry(entry: Entry, controller: model.Controller) -> model.Book:
+    book = extract.make_book(page_info(entry), book_url(entry), controller)
+    book.added = _parse_date(entry["Date Added"])
+    return book
+
+
+def add_shelf(book: model.Book, entry: Entry, reader: model.Reader) -> None:
+    """Adds the reading or wishlist of the shelf of `entry` to `book`"""
+    if entry["Exclusive Shelf"] == "read":
+        date = _parse_date(entry["Date Read"] or entry["Date Added"])
+        rating = _int(entry.get("My Rating", ""))
+        book.readings.append(
+            model.BookReader(None, reader, book, date, date, True, False, rating, "")
+        )
+    elif entry["Exclusive Shelf"] == "to-read":
+        date = _parse_date(entry["Date Added"])
+        book.wishlists.append(model.Wishlist(None, date, reader, book))
+    else:
+        logger.warning(f"Book {entry['Title']} wasn't read or wtr: {entry}")
+
+
+def _book_key(book: model.Book) -> Hashable:
+    if book.isbn is not None:
+        return book.isbn
+    return book.title, frozenset(auth.author.name for auth in book.authors)
+
+
+@attr.s(auto_attribs=True)
+class Progress(object):
+    """Counts of the entries processed by an ImportJob run"""
+
+    total: int
+    started: float = attr.ib(factory=time.monotonic)
+    counts: Dict[str, int] = attr.ib(factory=dict)
+
+    @property
+    def processed(self) -> int:
+        return sum(self.counts.values())
+
+    @property
+    def rate(self) -> float:
+        """Entries processed per second"""
+        elapsed = time.monotonic() - self.started
+        return self.processed / elapsed if elapsed > 0 else 0.0
+
+    @property
+    def eta(self) -> Optional[datetime.timedelta]:
+        if self.rate == 0:
+            return None
+        return datetime.timedelta(
+            seconds=round((self.total - self.processed) / self.rate)
+        )
+
+    def __str__(self) -> str:
+        return (
+            f"{self.processed}/{self.total} entries, {self.rate:.1f} entries/s,"
+            f" ETA {'?' if self.eta is None else self.eta}"
+        )
+
+
+class ImportJob(object):
+    """Resumable import of a goodreads library export
+
+    The state of each entry is kept in the GoodreadsImport table of the target
+    database, and entries that were imported, or were already in the database, are
+    skipped when the job is run again. Books are added in batches of `batch_size`
+    entries, each committed together with the state of its entries, so an
+    interrupted run loses at most the batch in progress.
+
+    With `scrape` False, books are built from the CSV columns alone, without
+    fetching any page. Their genres can be added later with `enrich`.
+    """
+
+    def __init__(
+        self,
+        controller: model.Controller,
+        entries: List[Entry],
+        fetcher: Optional[Fetcher] = None,
+        batch_size: int = 50,
+        scrape: bool = True,
+    ) -> None:
+        if controller.user is None:
+            raise ValueError("Goodreads import needs a user")
+        self.controller = controller
+        self.fetcher = fetcher
+        self.batch_size = batch_size
+        self.scrape = scrape
+        with controller.db:
+            controller.execute(
+                """create table if not exists GoodreadsImport(
+                    id TEXT PRIMARY KEY,
+                    entry TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    error TEXT,
+                    book INTEGER REFERENCES Books (id) ON DELETE SET NULL,
+                    enriched INTEGER NOT NULL DEFAULT 0)"""
+            )
+            controller.execute(
+                """create index if not exists GoodreadsImportStatus
+                on GoodreadsImport(status)"""
+            )
+            controller.db.executemany(
+                """insert or ignore into GoodreadsImport(id, entry, status)
+                values (?, ?, ?)""",
+                [(entry["Book Id"], json.dumps(entry), PENDING) for entry in entries],
+            )
+
+    def entries(self, *statuses: str) -> List[Entry]:
+        """Entries with any of `statuses`, in the order they were added"""
+        rows = self.controller.execute(
+            f"""select entry from GoodreadsImport
+            where status in ({", ".join("?" for _ in statuses)}) order by rowid""",
+            statuses,
+        )
+        return [json.loads(row[0]) for row in rows]
+
+    def counts(self) -> Dict[str, int]:
+        return dict(
+            self.controller.execute(
+                "select status, count(*) from GoodreadsImport group by status"
+            ).fetchall()
+        )
+
+    def _flush(
+        self,
+        batch: List[Tuple[Entry, model.Book]],
+        statuses: List[Tuple[str, Optional[str], str]],
+    ) -> None:
+        # Written only now, so no transaction is kept open while pages are fetched.
+        # The statuses, books and their ids are committed together, so a crash
+        # can't leave entries done without their book
+        with self.controller.transaction():
+            self.controller.db.executemany(
+                "update GoodreadsImport set status = ?, error = ? where id = ?",
+                statuses,
+            )
+            if len(batch) > 0:
+                self.controller.add_books(book for _, book in batch)
+                self.controller.db.executemany(
+                    "update GoodreadsImport set book = ? where id = ?",
+                    [(book.id, entry["Book Id"]) for entry, book in batch],
+                )
+        statuses.clear()
+        batch.clear()
+
+    def _books(
+        self, urls: Dict[str, Entry]
+    ) -> Iterator[Tuple[str, Union[model.Book, Exception]]]:
+        if self.scrape:
+            yield from extract.import_books(urls, self.controller, self.fetcher)
+            return
+        for url, entry in urls.items():
+            try:
+                yield url, book_from_entry(entry, self.controller)
+            except Exception as e:
+                yield url, e
+
+    def run(
+        self,
+        retry_failed: bool = False,
+        on_batch: Optional[Callable[[Progress], None]] = None,
+    ) -> Iterator[Tuple[Entry, str, Optional[Exception]]]:
+        """Imports the pending entries, yielding (entry, status, error) for each
+
+        Entries that failed in previous runs are retried too if `retry_failed`.
+        `on_batch` is called with the progress of the run after each committed
+        batch. Closing the iterator discards the batch in progress.
+        """
+        states = [PENDING, FETCH_FAILED, FAILED] if retry_failed else [PENDING]
+        urls = {book_url(entry): entry for entry in self.entries(*states)}
+        progress = Progress(len(urls))
+        batch: List[Tuple[Entry, model.Book]] = []
+        statuses: List[Tuple[str, Optional[str], str]] = []
+        keys: Set[Hashable] = set()
+        unflushed = 0
+        try:
+            for url, book in self._books(urls):
+                entry = urls[url]
+                error: Optional[Exception]
+                if isinstance(book, model.Book) and _book_key(book) in keys:
+                    book = extract.BookExists(f"Book at {url} is already imported")
+
+                if isinstance(book, extract.BookExists):
+                    status, error = EXISTS, book
+                elif isinstance(book, ConnectionError):
+                    status, error = FETCH_FAILED, book
+                elif isinstance(book, Exception):
+                    status, error = FAILED, book
+                else:
+                    assert self.controller.user is not None  # mypy hint
+                    add_shelf(book, entry, self.controller.user)
+                    keys.add(_book_key(book))
+                    batch.append((entry, book))
+                    status, error = DONE, None
+                statuses.append(
+                    (status, None if error is None else str(error), entry["Book Id"])
+                )
+                progress.counts[status] = progress.counts.get(status, 0) + 1
+                yield entry, status, error
+
+                unflushed += 1
+                if unflushed >= self.batch_size:
+                    self._flush(batch, statuses)
+                    unflushed = 0
+                    if on_batch is not None:
+                        on_batch(progress)
+            if unflushed > 0:
+                self._flush(batch, statuses)
+                if on_batch is not None:
+                    on_batch(progress)
+        except BaseException:
+            self.controller.db.rollback()
+            raise
+
+    def enrich(
+        self, on_batch: Optional[Callable[[Progress], None]] = None
+    ) -> Iterator[Tuple[Entry, Optional[Exception]]]:
+        """Adds the genres in the goodreads pages of the imported books, yielding
+        (entry, error) for each
+
+        Books are only enriched once, even across runs, and those whose page
+        couldn't be obtained are retried on the next run.
+        """
+        rows = self.controller.execute(
+            f"""select entry, book from GoodreadsImport
+            where status = '{DONE}' and enriched = 0 and book is not null
+            order by rowid"""
+        ).fetchall()
+        books = {}
+        for entry_json, id in rows:
+            entry = json.loads(entry_json)
+            books[book_url(entry)] = (entry, id)
+        progress = Progress(len(books))
+        batch: List[Tuple[Entry, int, Tuple[str, ...]]] = []
+        try:
+            for url, info in extract.import_pages(books, self.fetcher):
+                entry, id = books[url]
+                if isinstance(info, Exception):
+                    status, error = FAILED, info
+                else:
+                    batch.append((entry, id, info.genres))
+                    status, error = DONE, None
+                progress.counts[status] = progress.counts.get(status, 0) + 1
+                yield entry, error
+
+                if len(batch) >= self.batch_size:
+                    self._flush_genres(batch)
+                    if on_batch is not None:
+                        on_batch(progress)
+            if len(batch) > 0:
+                self._flush_genres(batch)
+            if on_batch is not None:
+                on_batch(progress)
+        except BaseException:
+            self.controller.db.rollback()
+            raise
+
+    def _flush_genres(self, batch: List[Tuple[Entry, int, Tuple[str, ...]]]) -> None:
+        books = {
+            book.id: book
+            for book in self.controller.get_books(id for _, id, _ in batch)
+        }
+        items = []
+        for _, id, genres in batch:
+            if (book := books.get(id)) is None:
+                continue
+            key = model.EntityRegistry.key
+            present = {key(item.genre.name) for item in book.genres}
+            items.extend(
+                self.controller.make_book_genres(
+                    book, [genre for genre in genres if key(genre) not in present]
+                )
+            )
+        # Committed together with the genres
+        with self.controller.transaction():
+            self.controller.db.executemany(
+                "update GoodreadsImport set enriched = 1 where id = ?",
+                [(entry["Book Id"],) for entry, _, _ in batch],
+            )
+            if len(items) > 0:
+                self.controller.add_book_genres(items)
+        batch.clear()
+
+
+def test_import_job_resume(tmp_path) -> None:
+    from qtbooks.pagecache import PageCache
+
+    pages = ["multiple_authors", "no_publisher", "null_isbn", "series", "uncached"]
+    entries = [
+        {
+            "Book Id": name,
+            "Title": name,
+            "Exclusive Shelf": "read",
+            "Date Added": "2020/01/02",
+            "Date Read": "2021/03/04",
+            "My Rating": "4",
+        }
+        for name in pages
+    ]
+    cache = PageCache(tmp_path / "pages.sqlite")
+    for entry in entries[:-1]:
+        text = (extract.TEST_PAGES / f"{entry['Book Id']}.html").read_text()
+        cache.put(book_url(entry), text)
+    fetcher = Fetcher(cache=cache, offline=True)
+    controller = model.Controller(str(tmp_path / "books.sqlite"))
+    controller.change_user("fran")
+
+    # Stopped after the first batch and an entry of the second
+    job = ImportJob(controller, entries, fetcher, batch_size=2)
+    run = job.run()
+    for _ in range(3):
+        next(run)
+    run.close()
+    assert sum(job.counts().values()) == len(entries)
+    assert controller.execute("select count(*) from Books").fetchone()[0] == 2
+
+    job = ImportJob(controller, entries, fetcher, batch_size=2)
+    results = {entry["Book Id"]: status for entry, status, _ in job.run()}
+    assert len(results) == 3
+    assert job.counts() == {DONE: 4, FETCH_FAILED: 1}
+    titles = [r[0] for r in controller.execute("select title from Books")]
+    assert len(titles) == len(set(titles)) == 4
+    assert list(job.run()) == []
+
+    cache.put(book_url(entries[-1]), cache.get(book_url(entries[0])) or "")
+    results = {entry["Book Id"]: status for entry, status, _ in job.run(True)}
+    assert results == {"uncached": EXISTS}
+    assert job.counts() == {DONE: 4, EXISTS: 1}
+    rows = controller.execute("select book from GoodreadsImport where status = 'done'")
+    assert len({book for book, in rows if book is not None}) == 4
@@ -1,11 +1,27 @@
+import os
 import sys
+import re
 import datetime
-from typing import Optional, List
+import threading
+import time
+from collections import OrderedDict
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    FrozenSet,
+    Optional,
+    List,
+    Sequence,
+    Set,
+    Tuple,
+)
 import traceback
 from pkg_resources import resource_filename
 
 from PyQt5 import QtWidgets as qtw, QtCore as qtc, QtGui as qtg
 from qtbooks import model, config, extract, LOGGER_DEBUG_CONFIG
+from qtbooks.asyncdb import AsyncController
 
 import logging
 import logging.config
@@ -14,6 +30,10 @@ logger = logging.getLogger(__name__)
 
 
 class App(qtw.QMainWindow):
+    start_import = qtc.pyqtSignal(list)
+    # How often to check for changes made by other instances
+    REFRESH_MS = 2000
+
     def __init__(self, controller: model.Controller, options: config.Options) -> None:
         super().__init__()
         self.title = "QtBooks"
@@ -23,12 +43,31 @@ class App(qtw.QMainWindow):
         self.h = 480
         self.controller = controller
         self.options = options
+        self.async_controller = AsyncController(controller)
+        self.async_controller.books_changed.connect(self.books_changed)
         self.view_pages: List[Table] = []
-        self.search_thread = qtc.QThread()
-        self.search_thread.start()
+        self.filter_pool = qtc.QThreadPool(self)
+        self.import_thread = qtc.QThread()
+        self.import_thread.start()
+        self.import_worker = ImportWorker(self.import_thread)
+        self.import_worker.page_ready.connect(self.import_page)
+        self.import_worker.finished.connect(self.import_finished)
+        self.start_import.connect(self.import_worker.run)
+        self.import_failures: List[Tuple[str, Exception]] = []
         self.initUI()
+        self.controller.add_listener(self.books_changed)
+        self.refresh_timer = qtc.QTimer(self)
+        self.refresh_timer.timeout.connect(self.check_external_changes)
+        self.refresh_timer.start(App.REFRESH_MS)
 
     def clean_up(self) -> None:
+        self.refresh_timer.stop()
+        self.filter_pool.clear()
+        self.filter_pool.waitForDone()
+        self.import_worker.cancel()
+        self.import_thread.quit()
+        self.import_thread.wait()
+        self.async_controller.shutdown()
         self.controller.release_lock()
 
     def initUI(self) -> None:
@@ -48,9 +87,12 @@ class App(qtw.QMainWindow):
             self.select_user()
 
         self.tabs = qtw.QTabWidget()
+        self.tabs.currentChanged.connect(self.load_view)
         for view in self.options.views:
-            view_page = Table(view, self.controller, self.search_thread)
-            view_page.cellDoubleClicked.connect(self.edit_book)
+            view_page = Table(
+                view, self.controller, self.async_controller, self.filter_pool
+            )
+            view_page.doubleClicked.connect(self.edit_book)
             self.view_pages.append(view_page)
             self.tabs.addTab(view_page, f"{view.shortcut}: {view.name}")
             shortcut = qtw.QShortcut(qtg.QKeySequence(view.shortcut), self)
@@ -72,6 +114,17 @@ class App(qtw.QMainWindow):
             notice.setText("Lock file found, running in read-only mode")
             notice.exec()
         self.set_shortcuts()
+        if self.options.warm_up:
+            qtc.QTimer.singleShot(0, self.warm_up)
+
+    def load_view(self, index: int) -> None:
+        if index >= 0:
+            self.view_pages[index].ensure_loaded()
+
+    def warm_up(self) -> None:
+        """Loads the remaining views in the background"""
+        for t in self.view_pages:
+            t.ensure_loaded()
 
     def change_view(self, view: "Table"):
         self.tabs.setCurrentWidget(view)
@@ -81,6 +134,8 @@ class App(qtw.QMainWindow):
         if hasattr(self, "tabs"):
             current = self.tabs.currentWidget()
             for t in self.view_pages:
+                if not t.loaded:
+                    continue
                 self.tabs.setCurrentWidget(t)
                 t.horizontalHeader().resizeSections(qtw.QHeaderView.Stretch)
             self.tabs.setCurrentWidget(current)
@@ -122,35 +177,39 @@ class App(qtw.QMainWindow):
             status.addPermanentWidget(self.status_readonly)
         self.status_help = qtw.QLabel(status)
         status.addWidget(self.status_help)
+        self.import_panel = ImportPanel(status)
+        self.import_panel.cancel_button.clicked.connect(self.cancel_import)
+        status.addPermanentWidget(self.import_panel)
+        self.import_panel.hide()
 
         self.setStatusBar(status)
 
-    def edit_book(self, i: int, j: int) -> None:
+    def edit_book(self, index: qtc.QModelIndex) -> None:
         try:
-            book_id = self.sender().item(self.sender().currentRow(), 0).text()
-        except ValueError:
+            book_id = self.sender().book_id(index)
+        except (ValueError, TypeError):
             return
-        book = self.controller.get_book(int(book_id))
-        bookdiag = BookDialog(self.controller, book)
+        bookdiag = BookDialog(self.controller, loading=True)
+        self.async_controller.get_entity_names(bookdiag.set_names)
+        self.async_controller.get_book(book_id, bookdiag.set_book, bookdiag.load_failed)
         msgstr = None
         if bookdiag.exec() == qtw.QDialog.Accepted:
             if self.controller.readonly:
                 msgstr = "Can't modify book in read-only mode"
             else:
                 book = bookdiag.get_book()
-                self.controller.update_book(book)
-        elif bookdiag.delete_book:
+                self.async_controller.update_book(book, on_error=self.write_failed)
+        elif bookdiag.delete_book and bookdiag.book is not None:
             if self.controller.readonly:
                 msgstr = "Can't delete book in read-only mode"
             else:
-                self.controller.delete_book(book)
+                self.async_controller.delete_book(
+                    bookdiag.book, on_error=self.write_failed
+                )
         if msgstr is not None:
             msg = qtw.QMessageBox(self)
             msg.setText(msgstr)
             msg.exec()
-            return
-        else:
-            self.update_tables()
 
     def add_book(self) -> None:
         if self.controller.readonly:
@@ -159,15 +218,35 @@ class App(qtw.QMainWindow):
             msg.exec()
             return
         bookdiag = BookDialog(self.controller)
+        self.async_controller.get_entity_names(bookdiag.set_names)
         if bookdiag.exec() == qtw.QDialog.Accepted:
             book = bookdiag.get_book()
-            self.controller.add_book(book)
-            self.update_tables()
+            self.async_controller.add_book(book, on_error=self.write_failed)
+
+    def write_failed(self, error: Exception) -> None:
+        logger.error(f"Failed to save changes: {error}", exc_info=error)
+        msg = qtw.QMessageBox(self)
+        msg.setText(f"Failed to save changes: {error}")
+        msg.exec()
 
     def update_tables(self) -> None:
         for t in self.view_pages:
             t.update_table()
 
+    def books_changed(self, ids: Set[int]) -> None:
+        for t in self.view_pages:
+            t.patch_rows(ids)
+
+    def check_external_changes(self) -> None:
+        """Reloads the views if another process wrote to the database"""
+
+        def checked(changed: bool) -> None:
+            if changed:
+                for t in self.view_pages:
+                    t.update_table(keep_filter=True)
+
+        self.async_controller.check_external_changes(checked)
+
     def set_shortcuts(self) -> None:
         shortcuts = [
             ("a", "Add book", self.add_book),
@@ -212,98 +291,571 @@ class App(qtw.QMainWindow):
         self.status_user.setText(f"User: {name}")
 
     def import_from_url(self) -> None:
+        if self.import_panel.isVisible():
+            msg = qtw.QMessageBox(self)
+            msg.setText("Wait for the current import to finish")
+            msg.exec()
+            return
+        if self.controller.readonly:
+            msg = qtw.QMessageBox(self)
+            msg.setText("Can't import books in read-only mode")
+            msg.exec()
+            return
         urls, ok = qtw.QInputDialog.getMultiLineText(
             self, "Import from url", "URL list, one per line", ""
         )
         if ok:
-            for url in urls.splitlines():
-                if url == "":
-                    continue
-                try:
-                    book = extract.import_book(url, self.controller)
-                    self.controller.add_book(book)
-                except Exception as e:
-                    qtw.QMessageBox.warning(
-                        self,
-                        "Unable to import",
-                        f"Could not import book at url {url}: \n{traceback.format_exc()}",
-                    )
+            urls = [url for url in urls.splitlines() if url != ""]
+            if len(urls) == 0:
+                return
+            self.import_failures = []
+            self.import_panel.start(len(urls))
+            self.import_worker.cancelled.clear()
+            self.start_import.emit(urls)
+
+    def cancel_import(self) -> None:
+        # Called directly, a queued slot of the worker would wait for the import
+        self.import_worker.cancel()
+
+    def import_page(self, url: str, info: Any) -> None:
+        """Adds the book of a page parsed by the import worker"""
+
+        def failed(error: Exception) -> None:
+            self.import_failures.append((url, error))
+            self.import_panel.add_result(failed=True)
+
+        if isinstance(info, Exception):
+            failed(info)
+            return
+        self.async_controller.write(
+            lambda c: c.add_book(extract.make_book(info, url, c)),
+            lambda _: self.import_panel.add_result(failed=False),
+            failed,
+        )
 
-        self.update_tables()
+    def import_finished(self) -> None:
+        # Writes run in order, so this comes after the books of every page
+        self.async_controller.write(lambda c: None, lambda _: self.import_summary())
 
+    def import_summary(self) -> None:
+        panel = self.import_panel
+        panel.hide()
+        if len(self.import_failures) == 0 and panel.remaining == 0:
+            return
+        text = f"Imported {panel.done} of {panel.total} books."
+        if panel.remaining > 0:
+            text += f" The import was cancelled before {panel.remaining} were fetched."
+        if len(self.import_failures) > 0:
+            text += f" Could not import {len(self.import_failures)}:\n"
+            text += "\n".join(url for url, _ in self.import_failures)
+        msg = qtw.QMessageBox(qtw.QMessageBox.Warning, "Import", text, parent=self)
+        msg.setDetailedText(
+            "\n".join(
+                f"{url}:\n"
+                + "".join(traceback.format_exception(type(e), e, e.__traceback__))
+                for url, e in self.import_failures
+            )
+        )
+        msg.setAttribute(qtc.Qt.WA_DeleteOnClose)
+        msg.setModal(False)
+        msg.show()
+
+
+class ImportWorker(qtc.QObject):
+    """Fetches and parses goodreads pages concurrently, away from the UI thread
 
-class TableFilter(qtc.QObject):
+    Each page is sent back with page_ready, so the books are made and added to the
+    database one at a time by the writer thread.
+    """
+
+    page_ready = qtc.pyqtSignal(str, object)
     finished = qtc.pyqtSignal()
 
-    def __init__(self, table: "Table", thread: qtc.QThread) -> None:
+    def __init__(self, thread: qtc.QThread) -> None:
         super().__init__()
-        self.table = table
-        self.filtered_rows = self.table.view_rows
-        self.jobs = 0
-        self.mutex = qtc.QMutex()
+        self.cancelled = threading.Event()
         self.moveToThread(thread)
 
-    def filter(self, exp: str) -> None:
-        self.mutex.lock()
-        if self.jobs > 1:
-            self.jobs -= 1
-            self.mutex.unlock()
+    def run(self, urls: List[str]) -> None:
+        pages = extract.import_pages(urls)
+        try:
+            for url, info in pages:
+                if self.cancelled.is_set():
+                    break
+                self.page_ready.emit(url, info)
+        except Exception:
+            logger.exception("Import failed")
+        finally:
+            # Cancels the pending fetches
+            pages.close()
+            self.finished.emit()
+
+    def cancel(self) -> None:
+        self.cancelled.set()
+
+
+class ImportPanel(qtw.QWidget):
+    """Progress of the running import, shown in the status bar"""
+
+    def __init__(self, parent: Optional[qtw.QWidget] = None) -> None:
+        super().__init__(parent)
+        self.total = 0
+        self.done = 0
+        self.failed = 0
+        layout = qtw.QHBoxLayout()
+        layout.setContentsMargins(0, 0, 0, 0)
+        self.label = qtw.QLabel()
+        layout.addWidget(self.label)
+        self.progress = qtw.QProgressBar()
+        layout.addWidget(self.progress)
+        self.cancel_button = qtw.QPushButton("Cancel")
+        layout.addWidget(self.cancel_button)
+        self.setLayout(layout)
+
+    @property
+    def remaining(self) -> int:
+        return self.total - self.done - self.failed
+
+    def start(self, total: int) -> None:
+        self.total = total
+        self.done = 0
+        self.failed = 0
+        self.progress.setRange(0, total)
+        self.update_progress()
+        self.show()
+
+    def add_result(self, failed: bool) -> None:
+        if failed:
+            self.failed += 1
+        else:
+            self.done += 1
+        self.update_progress()
+
+    def update_progress(self) -> None:
+        self.progress.setValue(self.done + self.failed)
+        self.label.setText(
+            f"Importing: {self.done} done, {self.failed} failed,"
+            f" {self.remaining} remaining"
+        )
+
+
+class FilterJob(object):
+    """Matching of a filter against a search index, split in chunks"""
+
+    def __init__(
+        self,
+        generation: int,
+        row_filter: model.RowFilter,
+        index: model.SearchIndex,
+        chunks: int,
+    ) -> None:
+        self.generation = generation
+        self.row_filter = row_filter
+        self.index = index
+        self.pending = chunks
+        self.matched: List[int] = []
+        self.started = time.monotonic()
+
+
+class FilterChunk(qtc.QRunnable):
+    def __init__(
+        self, scheduler: "FilterScheduler", job: FilterJob, rows: Sequence[int]
+    ) -> None:
+        super().__init__()
+        self.scheduler = scheduler
+        self.job = job
+        self.rows = rows
+
+    def run(self) -> None:
+        # Chunks of superseded filters are skipped without matching anything
+        if self.job.generation != self.scheduler.generation:
             return
-        self.mutex.unlock()
-        logger.debug(f"Running filter with {exp=}")
+        matched = self.job.row_filter.match_index(self.job.index, self.rows)
+        self.scheduler.chunk_done.emit(self.job, matched)
+
+
+class FilterScheduler(qtc.QObject):
+    """Runs the filters of a table on a thread pool
+
+    Filters are started once the expression stops changing for DEBOUNCE_MS, and
+    their rows are matched in chunks spread over the pool. Each filter gets a new
+    generation, and the chunks and results of older generations are dropped, so
+    results are never applied out of order. Rows matched so far are shown when a
+    filter takes longer than PARTIAL_MS.
 
-        if exp == "":
-            filtered_rows = self.table.view_rows
+    Results of the last CACHE_SIZE expressions are kept for the current search
+    index. Equivalent filters reuse them right away, and stricter ones only match
+    the rows of the smallest result they narrow down.
+    """
+
+    filtered = qtc.pyqtSignal(object)
+    chunk_done = qtc.pyqtSignal(object, object)
+
+    DEBOUNCE_MS = 150
+    PARTIAL_MS = 100
+    CHUNK_SIZE = 5000
+    CACHE_SIZE = 8
+
+    def __init__(self, table: "Table", pool: qtc.QThreadPool) -> None:
+        super().__init__()
+        self.table = table
+        self.pool = pool
+        self.generation = 0
+        self.row_filter: Optional[model.RowFilter] = None
+        self.job: Optional[FilterJob] = None
+        self.results: "OrderedDict[str, Tuple[model.RowFilter, FrozenSet[int]]]" = (
+            OrderedDict()
+        )
+        self.results_index: Optional[model.SearchIndex] = None
+        self.timer = qtc.QTimer(self)
+        self.timer.setSingleShot(True)
+        self.timer.setInterval(self.DEBOUNCE_MS)
+        self.timer.timeout.connect(self._start)
+        self.chunk_done.connect(self._chunk_done)
+
+    def schedule(self, row_filter: Optional[model.RowFilter]) -> None:
+        self.generation += 1
+        self.row_filter = row_filter
+        self.job = None
+        self.timer.stop()
+        if row_filter is None:
+            self.filtered.emit(None)
+            return
+        cached, result = self._lookup(row_filter)
+        if cached and result is not None:
+            self.filtered.emit(set(result))
         else:
-            try:
-                row_filter = model.RowFilter(exp)
-            except ValueError:
-                filtered_rows = self.table.view_rows
-            else:
-                filtered_rows = []
-                for row in self.table.view_rows:
-                    self.mutex.lock()
-                    if self.jobs > 1:
-                        self.jobs -= 1
-                        self.mutex.unlock()
-                        return
-                    self.mutex.unlock()
-                    if row_filter.matches(row):
-                        filtered_rows.append(row)
-
-        self.filtered_rows = filtered_rows
-        self.finished.emit()
-        self.mutex.lock()
-        self.jobs -= 1
-        self.mutex.unlock()
-
-    def abort(self) -> None:
-        self.mutex.lock()
-        self.jobs += 1
-        self.mutex.unlock()
-
-
-class Table(qtw.QTableWidget):
-    filter_signal = qtc.pyqtSignal(str)
+            self.timer.start()
+
+    def _lookup(
+        self, row_filter: model.RowFilter
+    ) -> Tuple[bool, Optional[FrozenSet[int]]]:
+        """Whether a cached result is the one of `row_filter`, or else the smallest
+        one containing every row it matches, if any"""
+        if self.results_index is not self.table.view_model.search_index:
+            self.results.clear()
+            self.results_index = self.table.view_model.search_index
+        best = None
+        for exp, (cached, accepted) in self.results.items():
+            if row_filter.implies(cached):
+                if cached.implies(row_filter):
+                    self.results.move_to_end(exp)
+                    return True, accepted
+                if best is None or len(accepted) < len(best):
+                    best = accepted
+        return False, best
+
+    def _start(self) -> None:
+        if self.row_filter is None:
+            return
+        logger.debug(f"Running filter with {self.row_filter.exp}")
+        self.generation += 1
+        index = self.table.view_model.search_index
+        _, candidates = self._lookup(self.row_filter)
+        rows: Sequence[int] = (
+            range(len(index)) if candidates is None else sorted(candidates)
+        )
+        chunks = [
+            rows[start : start + self.CHUNK_SIZE]
+            for start in range(0, len(rows), self.CHUNK_SIZE)
+        ]
+        self.job = FilterJob(self.generation, self.row_filter, index, len(chunks))
+        if len(chunks) == 0:
+            self._finish(self.job)
+        for chunk in chunks:
+            self.pool.start(FilterChunk(self, self.job, chunk))
+
+    def _chunk_done(self, job: FilterJob, matched: List[int]) -> None:
+        if job is not self.job:
+            return
+        if job.index is not self.table.view_model.search_index:
+            # Rows were patched while filtering
+            self._start()
+            return
+        job.matched.extend(matched)
+        job.pending -= 1
+        if job.pending == 0:
+            self._finish(job)
+        elif time.monotonic() - job.started > self.PARTIAL_MS / 1000:
+            self.filtered.emit(set(job.matched))
+
+    def _finish(self, job: FilterJob) -> None:
+        result = frozenset(job.matched)
+        self.results[job.row_filter.exp] = (job.row_filter, result)
+        while len(self.results) > self.CACHE_SIZE:
+            self.results.popitem(last=False)
+        self.job = None
+        # The table patches its accepted rows in place
+        self.filtered.emit(set(result))
+
+
+class ViewModel(qtc.QAbstractTableModel):
+    """Serves the cells of a view straight from the rows returned by the controller
+
+    Rows are kept in the order they were loaded and shown in the order of the
+    current sort, `order`, a permutation of their indices. The typed sort keys of
+    each column and the permutations sorting them are cached until the rows change.
+    """
+
+    def __init__(self, rows: List[model.Row], header: List[str]) -> None:
+        super().__init__()
+        self.rows = rows
+        self.header = header
+        self.search_index = model.SearchIndex.build(rows, header)
+        self.sort_column = -1
+        self.sort_order = qtc.Qt.AscendingOrder
+        self.order: List[int] = list(range(len(rows)))
+        # Inverse of order, built when needed
+        self.positions: Optional[List[int]] = None
+        self.sort_keys: Dict[int, List[Tuple]] = {}
+        self.permutations: Dict[Tuple[int, int], List[int]] = {}
+
+    def set_rows(
+        self, rows: List[model.Row], header: Optional[List[str]] = None
+    ) -> None:
+        if rows is self.rows and header in (None, self.header):
+            # The controller cache returned the same rows, nothing changed
+            return
+        self.beginResetModel()
+        self.rows = rows
+        if header is not None:
+            self.header = header
+        self.search_index = model.SearchIndex.build(rows, self.header)
+        self.sort_keys = {}
+        self.permutations = {}
+        self.order = self._permutation()
+        self.positions = None
+        self.endResetModel()
+
+    def row(self, position: int) -> model.Row:
+        """Row shown at `position`"""
+        return self.rows[self.order[position]]
+
+    def position(self, i: int) -> int:
+        """Position at which the row `i` is shown"""
+        if self.positions is None:
+            self.positions = [0] * len(self.order)
+            for position, j in enumerate(self.order):
+                self.positions[j] = position
+        return self.positions[i]
+
+    def _permutation(self) -> List[int]:
+        col = self.sort_column
+        if not 0 <= col < len(self.header):
+            return list(range(len(self.rows)))
+        if (permutation := self.permutations.get((col, self.sort_order))) is None:
+            if (keys := self.sort_keys.get(col)) is None:
+                keys = self.sort_keys[col] = [
+                    model.sort_key(row[col]) for row in self.rows
+                ]
+            # Sorting in reverse keeps ties in their order, like Qt does
+            permutation = sorted(
+                range(len(keys)),
+                key=keys.__getitem__,
+                reverse=self.sort_order == qtc.Qt.DescendingOrder,
+            )
+            self.permutations[col, self.sort_order] = permutation
+        return permutation
+
+    def _set_order(self, order: List[int]) -> None:
+        if order == self.order:
+            return
+        self.layoutAboutToBeChanged.emit()
+        old_order = self.order
+        self.order = order
+        self.positions = None
+        persistent = self.persistentIndexList()
+        self.changePersistentIndexList(
+            persistent,
+            [
+                self.index(self.position(old_order[index.row()]), index.column())
+                for index in persistent
+            ],
+        )
+        self.layoutChanged.emit()
+
+    def sort(
+        self, column: int, order: qtc.Qt.SortOrder = qtc.Qt.AscendingOrder
+    ) -> None:
+        if (column, order) == (self.sort_column, self.sort_order):
+            return
+        self.sort_column = column
+        self.sort_order = order
+        self._set_order(self._permutation())
+
+    # The patching methods replace the list of rows and the search index instead of
+    # modifying them, since filter jobs may be iterating over the old ones. The
+    # patched rows are moved to their sorted positions
+
+    def replace_row(self, i: int, row: model.Row) -> None:
+        self.rows = self.rows[:i] + [row] + self.rows[i + 1 :]
+        self.search_index = self.search_index.replace(i, row)
+        self.sort_keys = {}
+        self.permutations = {}
+        position = self.position(i)
+        self.dataChanged.emit(
+            self.index(position, 0), self.index(position, len(self.header) - 1)
+        )
+        self._set_order(self._permutation())
+
+    def remove_row(self, i: int) -> None:
+        position = self.position(i)
+        self.beginRemoveRows(qtc.QModelIndex(), position, position)
+        self.rows = self.rows[:i] + self.rows[i + 1 :]
+        self.search_index = self.search_index.remove(i)
+        self.sort_keys = {}
+        self.permutations = {}
+        self.order = [j if j < i else j - 1 for j in self.order if j != i]
+        self.positions = None
+        self.endRemoveRows()
+
+    def append_rows(self, rows: List[model.Row]) -> None:
+        n = len(self.rows)
+        self.beginInsertRows(qtc.QModelIndex(), n, n + len(rows) - 1)
+        self.rows = self.rows + rows
+        self.search_index = self.search_index.append(rows)
+        self.sort_keys = {}
+        self.permutations = {}
+        self.order = self.order + list(range(n, n + len(rows)))
+        self.positions = None
+        self.endInsertRows()
+        self._set_order(self._permutation())
+
+    def rowCount(self, parent: qtc.QModelIndex = qtc.QModelIndex()) -> int:
+        return 0 if parent.isValid() else len(self.rows)
+
+    def columnCount(self, parent: qtc.QModelIndex = qtc.QModelIndex()) -> int:
+        return 0 if parent.isValid() else len(self.header)
+
+    def data(self, index: qtc.QModelIndex, role: int = qtc.Qt.DisplayRole) -> Any:
+        if not index.isValid() or role != qtc.Qt.DisplayRole:
+            return None
+        return f"{self.rows[self.order[index.row()]][index.column()]}"
+
+    def headerData(
+        self,
+        section: int,
+        orientation: qtc.Qt.Orientation,
+        role: int = qtc.Qt.DisplayRole,
+    ) -> Any:
+        if orientation == qtc.Qt.Horizontal and role == qtc.Qt.DisplayRole:
+            return self.header[section]
+        return None
+
+
+class FilterProxy(qtc.QSortFilterProxyModel):
+    """Hides the rows of the view model rejected by the current filter
+
+    Sorting is left to the view model, which keeps the sorted orders.
+    """
+
+    def __init__(self) -> None:
+        super().__init__()
+        # Indices of the accepted rows of the view model, not their positions
+        self.accepted: Optional[Set[int]] = None
+
+    def set_accepted(self, accepted: Optional[Set[int]]) -> None:
+        self.accepted = accepted
+        self.invalidateFilter()
 
+    def sort(
+        self, column: int, order: qtc.Qt.SortOrder = qtc.Qt.AscendingOrder
+    ) -> None:
+        self.sourceModel().sort(column, order)
+
+    def filterAcceptsRow(self, source_row: int, source_parent: qtc.QModelIndex) -> bool:
+        if self.accepted is None:
+            return True
+        return self.sourceModel().order[source_row] in self.accepted
+
+    def shift_accepted(self, removed: int) -> None:
+        """Updates the accepted rows after removing the row `removed`"""
+        if self.accepted is not None:
+            self.accepted = {
+                i if i < removed else i - 1 for i in self.accepted if i != removed
+            }
+
+
+class Table(qtw.QTableView):
     def __init__(
         self,
         view: config.View,
         controller: model.Controller,
-        search_thread: qtc.QThread,
+        async_controller: AsyncController,
+        filter_pool: qtc.QThreadPool,
     ) -> None:
         super().__init__()
         self.view = view
         self.controller = controller
+        self.async_controller = async_controller
+        self.loaded = False
+        # Whether the rows of the view are being queried, and which query is current
+        self.loading = False
+        self.load_generation = 0
+        # Whether the rows of some books are being queried, and the next to query
+        self.patching = False
+        self.pending_patch: Set[int] = set()
+        self.header: List[str] = []
+        self.filter_exp = ""
+        self.row_filter: Optional[model.RowFilter] = None
 
         self.verticalHeader().setVisible(False)
-        rows, header = self.controller.get_view(self.view)
-        self.view_rows = rows
+        self.view_model = ViewModel([], [])
+        self.proxy = FilterProxy()
+        self.proxy.setSourceModel(self.view_model)
+        self.setModel(self.proxy)
+        header_widget = self.horizontalHeader()
+        header_widget.setContextMenuPolicy(
+            qtc.Qt.ContextMenuPolicy.ActionsContextMenu  # type: ignore
+        )
+        header_widget.setSectionResizeMode(qtw.QHeaderView.Interactive)
+        header_widget.setSortIndicatorShown(True)
+        self.setSelectionBehavior(qtw.QTableView.SelectRows)
+        self.setSelectionMode(qtw.QTableView.SingleSelection)
+        self.setEditTriggers(qtw.QTableView.NoEditTriggers)
+
+        self.scheduler = FilterScheduler(self, filter_pool)
+        self.scheduler.filtered.connect(self.proxy.set_accepted)
+
+    def ensure_loaded(self) -> None:
+        """Runs the view query in the background the first time the table is
+        needed"""
+        if self.loaded or self.loading:
+            return
+        self.view_model.set_rows([], ["Loading..."])
+        self._load(self._first_loaded)
+
+    def _load(self, on_loaded: Callable[[List[model.Row], List[str]], None]) -> None:
+        self.load_generation += 1
+        generation = self.load_generation
+        # Books changed before are in the new rows
+        self.pending_patch.clear()
+
+        def loaded(result: Tuple[List[model.Row], List[str]]) -> None:
+            # Results of superseded queries are dropped
+            if generation == self.load_generation:
+                self.loading = False
+                on_loaded(*result)
+
+        def failed(error: Exception) -> None:
+            if generation == self.load_generation:
+                self.loading = False
+                logger.error(f"Failed to load view {self.view.name}", exc_info=error)
+                if not self.loaded:
+                    self.view_model.set_rows([], ["Failed to load the view"])
+
+        self.loading = True
+        self.async_controller.get_view(self.view, loaded, failed)
+
+    def _first_loaded(self, rows: List[model.Row], header: List[str]) -> None:
         self.header = header
-        self.setColumnCount(len(self.header))
-        self.setHorizontalHeaderLabels(self.header)
+        self.view_model.set_rows(rows, header)
+        self.loaded = True
+
         self.sort_column = (
-            self.header.index(view.sort_col) if view.sort_col in self.header else -1
+            self.header.index(self.view.sort_col)
+            if self.view.sort_col in self.header
+            else -1
         )
         self.setSortingEnabled(True)
         if self.sort_column > -1:
@@ -314,14 +866,6 @@ class Table(qtw.QTableWidget):
                 else qtc.Qt.SortOrder.DescendingOrder,  # type: ignore
             )
         header_widget = self.horizontalHeader()
-        header_widget.setContextMenuPolicy(
-            qtc.Qt.ContextMenuPolicy.ActionsContextMenu  # type: ignore
-        )
-        header_widget.setSectionResizeMode(qtw.QHeaderView.Interactive)
-        header_widget.setSortIndicatorShown(True)
-        # header_widget.sectionClicked.connect(self.sort_by_column)
-        self.setSelectionBehavior(qtw.QTableWidget.SelectRows)
-        self.setSelectionMode(qtw.QTableWidget.SingleSelection)
         for i, h in enumerate(self.header):
             action = qtw.QAction(h, self)
             action.setCheckable(True)
@@ -334,55 +878,141 @@ class Table(qtw.QTableWidget):
                 lambda checked, col=i: self.toggle_column_hidden(col)
             )
             header_widget.addAction(action)
-
-        self.search_thread = search_thread
-        self.table_filter = TableFilter(self, search_thread)
-        self.filter_signal.connect(self.table_filter.filter)
-        self.table_filter.finished.connect(self._update_row_view)
-
-        self._update_row_view()
+        header_widget.resizeSections(qtw.QHeaderView.Stretch)
+        if self.filter_exp != "":
+            self.filter(self.filter_exp)
 
     def toggle_column_hidden(self, col: int) -> None:
         hide = not self.isColumnHidden(col)
         self.setColumnHidden(col, hide)
         self.horizontalHeader().actions()[col].setChecked(not hide)
 
-    def update_table(self) -> None:
-        rows, _ = self.controller.get_view(self.view)
-        self.view_rows = rows
-        self.filter("")
+    @property
+    def view_rows(self) -> List[model.Row]:
+        return self.view_model.rows
 
-    def filter(self, exp: str) -> None:
-        self.table_filter.abort()
-        self.filter_signal.emit(exp)
+    def book_id(self, index: qtc.QModelIndex) -> int:
+        source = self.proxy.mapToSource(index)
+        return int(self.view_model.row(source.row())[0])
 
-    def _update_row_view(self) -> None:
-        self.rows = self.table_filter.filtered_rows
+    def update_table(self, keep_filter: bool = False) -> None:
+        """Queries the rows of the view again in the background"""
+        if not self.loaded:
+            if self.loading:
+                # The pending query may have started before the change
+                self._load(self._first_loaded)
+            return
 
-        self.setSortingEnabled(False)
-        self.setRowCount(len(self.rows))
-        for i, row in enumerate(self.rows):
-            for j, col_name in enumerate(self.header):
-                item = qtw.QTableWidgetItem(f"{row[col_name]}")
-                item.setFlags(qtc.Qt.ItemFlag.ItemIsEnabled | qtc.Qt.ItemFlag.ItemIsSelectable)  # type: ignore
-                self.setItem(i, j, item)
+        def loaded(rows: List[model.Row], header: List[str]) -> None:
+            self.view_model.set_rows(rows)
+            self.filter(self.filter_exp if keep_filter else "")
 
-        self.setSortingEnabled(True)
+        self._load(loaded)
+
+    def patch_rows(self, ids: Set[int]) -> None:
+        """Reloads only the rows of the books in `ids` in the background, keeping
+        the current filter"""
+        if self.loading:
+            # The pending rows may be older than the change
+            self.update_table(keep_filter=True)
+            return
+        if not self.loaded:
+            return
+        if "id" not in self.header:
+            self.update_table()
+            return
+        self.pending_patch |= ids
+        if not self.patching:
+            self._request_patch()
+
+    def _request_patch(self) -> None:
+        # One query at a time, so older rows never replace newer ones
+        ids, self.pending_patch = self.pending_patch, set()
+        self.patching = True
+        generation = self.load_generation
+
+        def loaded(rows: List[model.Row]) -> None:
+            self.patching = False
+            # A reload requested meanwhile has the changes already
+            if generation == self.load_generation:
+                self._apply_patch(ids, rows)
+            if len(self.pending_patch) > 0:
+                self._request_patch()
+
+        def failed(error: Exception) -> None:
+            self.patching = False
+            logger.error(f"Failed to update view {self.view.name}", exc_info=error)
+            self.update_table(keep_filter=True)
+
+        self.async_controller.get_view_books(self.view, ids, loaded, failed)
+
+    def _apply_patch(self, ids: Set[int], fetched: List[model.Row]) -> None:
+        new_rows: Dict[int, List[model.Row]] = {}
+        for row in fetched:
+            new_rows.setdefault(row["id"], []).append(row)
+
+        def set_accepted(i: int, row: model.Row) -> None:
+            accepted = self.proxy.accepted
+            if accepted is not None and self.row_filter is not None:
+                if self.row_filter.matches(row):
+                    accepted.add(i)
+                else:
+                    accepted.discard(i)
+
+        removed = []
+        for i, row in enumerate(self.view_rows):
+            if row["id"] in ids:
+                if len(rows := new_rows.get(row["id"], [])) > 0:
+                    new_row = rows.pop(0)
+                    set_accepted(i, new_row)
+                    self.view_model.replace_row(i, new_row)
+                else:
+                    removed.append(i)
+        for i in reversed(removed):
+            self.view_model.remove_row(i)
+            self.proxy.shift_accepted(i)
+        appended = [row for rows in new_rows.values() for row in rows]
+        if len(appended) > 0:
+            for i, row in enumerate(appended, start=len(self.view_rows)):
+                set_accepted(i, row)
+            self.view_model.append_rows(appended)
+
+    def filter(self, exp: str) -> None:
+        row_filter: Optional[model.RowFilter]
+        try:
+            row_filter = model.RowFilter(exp) if exp else None
+        except (ValueError, re.error):
+            row_filter = None
+        self.filter_exp = exp
+        self.row_filter = row_filter
+        self.scheduler.schedule(row_filter)
 
 
 class BookDialog(qtw.QDialog):
+    """Form to add a new book or edit `book`
+
+    A `loading` dialog is disabled until the book to edit is passed to `set_book`.
+    """
+
     def __init__(
-        self, controller: model.Controller, book: Optional[model.Book] = None
+        self,
+        controller: model.Controller,
+        book: Optional[model.Book] = None,
+        loading: bool = False,
     ) -> None:
         super().__init__()
-        self.title = (
-            "Add a new book" if book is None else f"Editing book '{book.title}'"
-        )
+        if loading:
+            self.title = "Loading book..."
+        elif book is None:
+            self.title = "Add a new book"
+        else:
+            self.title = f"Editing book '{book.title}'"
         self.left = 10
         self.top = 10
         self.w = 800
         self.h = 480
         self.book = book
+        self.loading = loading
         self.delete_book = False
         self.controller = controller
         self.initUI()
@@ -413,13 +1043,14 @@ class BookDialog(qtw.QDialog):
         self.wisbn.setMaxLength(13)
         self.wisbn.setText("000000000")
         left_form.addRow("ISBN", self.wisbn)
-        self.wauthor = ComboWidget(self.controller.get_all_authors())
+        # The names to choose from are queried in the background, see set_names
+        self.wauthor = ComboWidget([])
         self.wauthor.combobox_made.connect(self.set_tab_order)
         left_form.addRow("Author", self.wauthor)
-        self.wgenre = ComboWidget(self.controller.get_all_genres())
+        self.wgenre = ComboWidget([])
         self.wgenre.combobox_made.connect(self.set_tab_order)
         left_form.addRow("Genre", self.wgenre)
-        self.wpublisher = ComboWidget(self.controller.get_all_publishers())
+        self.wpublisher = ComboWidget([])
         self.wpublisher.combobox_made.connect(self.set_tab_order)
         left_form.addRow("Publisher", self.wpublisher)
         self.wfirst = qtw.QSpinBox()
@@ -499,16 +1130,46 @@ class BookDialog(qtw.QDialog):
         forms.addLayout(right_form)
         self.forms = forms
 
+        # Disabling the container keeps the enabled state of each field
+        self.wforms = qtw.QWidget()
+        self.wforms.setLayout(forms)
+
         # Top layout
         top_layout = qtw.QVBoxLayout(self)
-        top_layout.addLayout(forms)
+        top_layout.addWidget(self.wforms)
         top_layout.addWidget(buttons)
         self.setLayout(top_layout)
 
         self.update_data()
         self.set_tab_order()
+        if self.loading:
+            self.set_editable(False)
         self.show()
 
+    def set_editable(self, editable: bool) -> None:
+        self.wforms.setEnabled(editable)
+        for button in [qtw.QDialogButtonBox.Ok, qtw.QDialogButtonBox.Discard]:
+            self.buttons.button(button).setEnabled(editable)
+
+    def set_book(self, book: model.Book) -> None:
+        """Shows `book`, once loaded, for editing"""
+        self.book = book
+        self.loading = False
+        self.title = f"Editing book '{book.title}'"
+        self.setWindowTitle(self.title)
+        self.update_data()
+        self.set_tab_order()
+        self.set_editable(True)
+
+    def set_names(self, names: Tuple[List[str], List[str], List[str]]) -> None:
+        """Offers the names of the authors, genres and publishers, once loaded"""
+        for widget, options in zip([self.wauthor, self.wgenre, self.wpublisher], names):
+            widget.set_options(options)
+
+    def load_failed(self, error: Exception) -> None:
+        logger.error("Failed to load book", exc_info=error)
+        self.setWindowTitle(f"Failed to load book: {error}")
+
     def reject_and_delete_book(self) -> None:
         self.delete_book = True
         self.reject()
@@ -599,24 +1260,17 @@ class BookDialog(qtw.QDialog):
         if len(authors) != len(book.authors) or any(
             a != b.author.name for a, b in zip(authors, book.authors)
         ):
-            book.authors = [
-                self.controller.get_or_make_book_author(book, name) for name in authors
-            ]
+            book.authors = self.controller.make_book_authors(book, authors)
 
         if len(genres) != len(book.genres) or any(
             a != b.genre.name for a, b in zip(genres, book.genres)
         ):
-            book.genres = [
-                self.controller.get_or_make_book_genre(book, name) for name in genres
-            ]
+            book.genres = self.controller.make_book_genres(book, genres)
 
         if len(publishers) != len(book.publishers) or any(
             a != b.publisher.name for a, b in zip(publishers, book.publishers)
         ):
-            book.publishers = [
-                self.controller.get_or_make_book_publisher(book, name)
-                for name in publishers
-            ]
+            book.publishers = self.controller.make_book_publishers(book, publishers)
 
         reading = next(
             (o for o in book.readings if o.reader.id == self.controller.user.id), None
@@ -769,8 +1423,16 @@ class ComboWidget(qtw.QWidget):
         self.setLayout(layout)
 
     def clear(self) -> None:
-        while self.combos.takeAt(0):
-            pass
+        while (item := self.combos.takeAt(0)) is not None:
+            item.widget().deleteLater()
+
+    def set_options(self, options: List[str]) -> None:
+        self.options = options
+        for combo in self.get_all_combos():
+            text = combo.currentText()
+            combo.clear()
+            combo.insertItems(0, options)
+            combo.setCurrentText(text)
 
     def get_all(self) -> List[str]:
         return [c.currentText() for c in self.get_all_combos() if c.currentText() != ""]
@@ -836,7 +1498,7 @@ def main(args: dict) -> None:
         rootlogger.setLevel(logging.INFO)
 
     app = qtw.QApplication(sys.argv)
-    controller = model.Controller(options.db_file)
+    controller = model.Controller(options.db_file, options.lockfile)
 
     def excepthook(exc_type, exc_value, exc_tb):
         traceback.print_exception(exc_type, exc_value, exc_tb)
@@ -849,3 +1511,23 @@ def main(args: dict) -> None:
     app.aboutToQuit.connect(window.clean_up)
 
     sys.exit(app.exec_())
+
+
+def test_book_dialog_combos(tmp_path) -> None:
+    os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+    app = qtw.QApplication.instance() or qtw.QApplication([])
+    controller = model.Controller(str(tmp_path / "books.sqlite"))
+    controller.change_user("fran")
+    book = model.Book(None, "Title", 2000, 1, datetime.date(2020, 1, 1), "", "")
+    book.authors = controller.make_book_authors(book, ["A", "B"])
+    dialog = BookDialog(controller, loading=True)
+    dialog.set_book(book)
+    app.processEvents()
+    app.sendPostedEvents(None, qtc.QEvent.DeferredDelete)
+    visible = [
+        combo.currentText()
+        for combo in dialog.wauthor.findChildren(qtw.QComboBox)
+        if combo.isVisibleTo(dialog)
+    ]
+    assert visible == ["A", "B"]
+    dialog.close()
@@ -1,17 +1,35 @@
+import contextlib
+import functools
 import json
 import re
+import threading
 import datetime
 import os
 import sqlite3 as sqlite
-from functools import lru_cache
 from sqlite3 import Connection, Row
-from typing import Optional, Union, Iterator, List, Tuple, Dict
+from typing import (
+    Any,
+    Optional,
+    Union,
+    Iterable,
+    Iterator,
+    List,
+    Tuple,
+    Dict,
+    Callable,
+    Set,
+    Hashable,
+    Type,
+    TypeVar,
+    Sequence,
+)
 from pathlib import Path
 
 from PyQt5.QtGui import QDesktopServices
 import attr
 
 from qtbooks import config
+from qtbooks.cache import TableCache, cached
 
 import logging
 
@@ -40,8 +58,12 @@ def _convert_date(date: Union[datetime.date, str]) -> Optional[datetime.date]:
 class TableI(object):
     id: Optional[int]
 
-    def values(self) -> List[str]:
-        return [_value_from_att(self, att) for att in attr.fields(self.__class__)]
+    def params(self) -> List:
+        """Values of the columns, in order, to bind to the statements of the class"""
+        return [
+            adapt(getattr(self, name))
+            for name, adapt in _statements(self.__class__).adapters
+        ]
 
     def columns(self) -> List[str]:
         return [att.name for att in attr.fields(self.__class__)]
@@ -57,17 +79,44 @@ class Book(TableI):
     isbn: str
 
     class RelationList(list):
-        def __init__(self, l: list, b: "Book") -> None:
-            super().__init__(l)
-            self.book = b
+        """Relations of a book, compared with its saved rows when it is saved
 
-        def append(self, x):
-            super().append(x)
-            self.book.has_dirty_relations = True
+        Items without an id are inserted, and the saved rows no longer in the list
+        are deleted. When the list replaces `replaced`, new items standing for the
+        same rows as saved ones take their ids.
+        """
 
-        def remove(self, x):
-            super().remove(x)
-            self.book.has_dirty_relations = True
+        def __init__(
+            self, l: list, b: "Book", replaced: Optional["Book.RelationList"] = None
+        ) -> None:
+            super().__init__(l)
+            self.book = b
+            # Rows of the book when it was last saved or loaded, by id
+            self.saved: Dict[int, TableI] = {}
+            if replaced is not None:
+                self.saved = dict(replaced.saved)
+                kept = {x.id for x in self if x.id is not None}
+                for old in self.saved.values():
+                    if old.id in kept:
+                        continue
+                    new = next(
+                        (x for x in self if x.id is None and _same_row(x, old)), None
+                    )
+                    if new is not None:
+                        new.id = old.id
+                        kept.add(old.id)
+
+        @property
+        def added(self) -> List[TableI]:
+            return [x for x in self if x.id is None]
+
+        @property
+        def removed(self) -> List[TableI]:
+            kept = {x.id for x in self}
+            return [x for id, x in self.saved.items() if id not in kept]
+
+        def clear_changes(self) -> None:
+            self.saved = {x.id: x for x in self if x.id is not None}
 
     def __attrs_post_init__(self) -> None:
         self.authors = []
@@ -76,7 +125,18 @@ class Book(TableI):
         self.readings = []
         self.owners = []
         self.wishlists = []
-        self.has_dirty_relations = False
+
+    def _set_relations(self, name: str, value: list) -> None:
+        replaced = getattr(self, f"_{name}", None)
+        setattr(self, f"_{name}", Book.RelationList(value, self, replaced))
+
+    def relation_lists(self) -> List["Book.RelationList"]:
+        return [getattr(self, f"_{name}") for name in RELATIONS]
+
+    def clear_changes(self) -> None:
+        """Marks the book as saved"""
+        for relations in self.relation_lists():
+            relations.clear_changes()
 
     @property
     def authors(self) -> List["BookAuthor"]:
@@ -84,8 +144,7 @@ class Book(TableI):
 
     @authors.setter
     def authors(self, value: List["BookAuthor"]) -> None:
-        self._authors = Book.RelationList(value, self)
-        self.has_dirty_relations = True
+        self._set_relations("authors", value)
 
     @property
     def genres(self) -> List["BookGenre"]:
@@ -93,8 +152,7 @@ class Book(TableI):
 
     @genres.setter
     def genres(self, value: List["BookGenre"]) -> None:
-        self._genres = Book.RelationList(value, self)
-        self.has_dirty_relations = True
+        self._set_relations("genres", value)
 
     @property
     def publishers(self) -> List["BookPublisher"]:
@@ -102,8 +160,7 @@ class Book(TableI):
 
     @publishers.setter
     def publishers(self, value: List["BookPublisher"]) -> None:
-        self._publishers = Book.RelationList(value, self)
-        self.has_dirty_relations = True
+        self._set_relations("publishers", value)
 
     @property
     def readings(self) -> List["BookReader"]:
@@ -111,8 +168,7 @@ class Book(TableI):
 
     @readings.setter
     def readings(self, value: List["BookReader"]) -> None:
-        self._readings = Book.RelationList(value, self)
-        self.has_dirty_relations = True
+        self._set_relations("readings", value)
 
     @property
     def owners(self) -> List["BookOwner"]:
@@ -120,8 +176,7 @@ class Book(TableI):
 
     @owners.setter
     def owners(self, value: List["BookOwner"]) -> None:
-        self._owners = Book.RelationList(value, self)
-        self.has_dirty_relations = True
+        self._set_relations("owners", value)
 
     @property
     def wishlists(self) -> List["Wishlist"]:
@@ -129,16 +184,11 @@ class Book(TableI):
 
     @wishlists.setter
     def wishlists(self, value: List["Wishlist"]) -> None:
-        self._wishlists = Book.RelationList(value, self)
-        self.has_dirty_relations = True
+        self._set_relations("wishlists", value)
 
     @property
     def has_dirty_relations(self) -> bool:
-        return self._has_dirty_relations
-
-    @has_dirty_relations.setter
-    def has_dirty_relations(self, value: bool) -> None:
-        self._has_dirty_relations = value
+        return any(r.added or r.removed for r in self.relation_lists())
 
 
 def book_from_dict(obj: Union[str, Book]) -> Book:
@@ -242,33 +292,105 @@ TABLES = [
 ]
 
 
-def _value_from_att(obj: TableI, att: attr.Attribute) -> str:
-    v = getattr(obj, att.name)
-    if v is None:
-        return "NULL"
-    elif att.type in TABLES:
-        return f"{v.id}"
+# Relation lists of a book, and the entity each of their items links it to
+RELATIONS: Dict[str, Optional[str]] = {
+    "authors": "author",
+    "genres": "genre",
+    "publishers": "publisher",
+    "readings": None,
+    "owners": None,
+    "wishlists": None,
+}
+
+
+def _same_row(a: TableI, b: TableI) -> bool:
+    """Whether the relations `a` and `b` of the same book hold the same values"""
+    return type(a) is type(b) and all(
+        getattr(a, att.name) == getattr(b, att.name)
+        for att in attr.fields(type(a))
+        if att.name not in ("id", "book")
+    )
+
+
+def _adapter(att: attr.Attribute) -> Callable[[Any], Any]:
+    """Converts values of `att` to the ones stored in the database"""
+    if att.type in TABLES:
+        return lambda v: None if v is None else v.id
     elif att.type is datetime.date:
-        return v.strftime("'%s'")
-    elif att.type is int:
-        return f"{v}"
+        # Stored as text, the seconds since the epoch
+        return lambda v: None if v is None else v.strftime("%s")
     elif att.type is bool:
-        return f"{v}"
-    elif att.type is str:
-        return "'{}'".format(v.replace("'", "''"))
+        return lambda v: None if v is None else int(v)
     else:
-        return f"'{v}'"
+        return lambda v: v
+
+
+@attr.s(auto_attribs=True, frozen=True)
+class _Statements(object):
+    """Parameterized statements writing the objects of a TableI class"""
+
+    insert: str
+    # Binds the values of every column but id, then the id
+    update: str
+    delete: str
+    adapters: Tuple[Tuple[str, Callable[[Any], Any]], ...]
+
+
+@functools.lru_cache(maxsize=None)
+def _statements(cls: Type[TableI]) -> _Statements:
+    # Built once per class, so the text of each statement is always the same and
+    # SQLite reuses its prepared statement
+    fields = attr.fields(cls)
+    table = f"{cls.__name__}s"
+    columns = [att.name for att in fields]
+    return _Statements(
+        insert=f"""insert into {table} ({" , ".join(columns)})
+        values ({" , ".join("?" for _ in columns)})""",
+        update=f"""update {table}
+        set {" , ".join(f"{col} = ?" for col in columns if col != "id")}
+        where id = ?""",
+        delete=f"delete from {table} where id = ?",
+        adapters=tuple((att.name, _adapter(att)) for att in fields),
+    )
+
+
+def _update_params(obj: TableI) -> List:
+    params = obj.params()
+    return params[1:] + params[:1]
+
 
+# Seconds a connection waits for another one to finish writing
+BUSY_TIMEOUT = 10.0
 
-def create_db(fn: str) -> Connection:
-    db = sqlite.connect(fn)
+
+def create_db(fn: str, wal: bool = True) -> Connection:
+    """Opens the database, creating or migrating it as needed
+
+    Without `wal` the database uses a rollback journal, the only mode SQLite supports
+    over network or synced folders, and is switched back to it if it was in WAL mode.
+    """
+    # Write transactions take the write lock as soon as they begin, so they wait
+    # for other writers up to the busy timeout instead of failing when upgrading
+    db = sqlite.connect(fn, timeout=BUSY_TIMEOUT, isolation_level="IMMEDIATE")
     db.row_factory = sqlite.Row
+    # Readers and the writer don't block each other in WAL mode, and several
+    # processes can use the database as long as they are on the same machine
+    mode = "wal" if wal else "delete"
+    try:
+        switched = db.execute(f"PRAGMA journal_mode = {mode}").fetchone()[0] == mode
+    except sqlite.OperationalError:
+        switched = False
+    if not switched:
+        logger.warning(f"Database in use elsewhere, can't switch it to {mode} mode")
+    if wal:
+        db.execute("PRAGMA synchronous = NORMAL")
 
     if (
         db.execute("SELECT name from sqlite_master where name = 'Books'").fetchone()
         is None
     ):
         init_db(db)
+    migrate_db(db)
 
     db.execute("PRAGMA foreign_keys = ON")
     if db.execute("PRAGMA foreign_keys").fetchone()[0] != 1:
@@ -277,6 +399,128 @@ def create_db(fn: str) -> Connection:
     return db
 
 
+def connect_readonly(fn: str) -> Connection:
+    """Read-only connection to an existing database"""
+    db = sqlite.connect(
+        f"{Path(fn).absolute().as_uri()}?mode=ro", uri=True, timeout=BUSY_TIMEOUT
+    )
+    db.row_factory = sqlite.Row
+    return db
+
+
+_BOOKS_VIEW_SELECT = """
+    select Books.id, title, Authors.authors, Genres.genres, Publishers.publishers, first_published, edition, isbn, notes, strftime('%%m/%%d/%%Y', added, 'unixepoch') as added
+    from Books left join
+            (
+            select b.id, group_concat(a.name) as authors
+            from Books as b join BookAuthors as ba on b.id = ba.book
+                            join Authors as a on ba.author = a.id
+            group by b.id
+            ) as Authors on Books.id = Authors.id left join
+            (
+            select b.id, group_concat(g.name) as genres
+            from Books as b join BookGenres as bg on b.id = bg.book
+                            join Genres as g on bg.genre = g.id
+            group by b.id
+            ) as Genres on Books.id = Genres.id left join
+            (
+            select b.id, group_concat(g.name) as publishers
+            from Books as b join BookPublishers as bg on b.id = bg.book
+                            join Publishers as g on bg.publisher = g.id
+            group by b.id
+            ) as Publishers on Books.id = Publishers.id
+"""
+
+# Same columns as _BOOKS_VIEW_SELECT, computed only for the books matching {cond}.
+# The relation columns are declared without type, so +Books.id drops the INTEGER
+# affinity that would otherwise keep SQLite from using their indexes
+_BOOK_SUMMARY_SELECT = """
+    select Books.id, title,
+           (select group_concat(a.name)
+            from BookAuthors as ba join Authors as a on ba.author = a.id
+            where ba.book = +Books.id) as authors,
+           (select group_concat(g.name)
+            from BookGenres as bg join Genres as g on bg.genre = g.id
+            where bg.book = +Books.id) as genres,
+           (select group_concat(p.name)
+            from BookPublishers as bp join Publishers as p on bp.publisher = p.id
+            where bp.book = +Books.id) as publishers,
+           first_published, edition, isbn, notes, strftime('%%m/%%d/%%Y', added, 'unixepoch') as added
+    from Books
+    where {cond}
+"""
+
+
+def _summary_triggers() -> Iterator[Tuple[str, str, str]]:
+    yield "Books", "insert", "new.id"
+    yield "Books", "update", "old.id, new.id"
+    for relation, table, col in [
+        ("BookAuthors", "Authors", "author"),
+        ("BookGenres", "Genres", "genre"),
+        ("BookPublishers", "Publishers", "publisher"),
+    ]:
+        yield relation, "insert", "new.book"
+        yield relation, "delete", "old.book"
+        yield relation, "update", "old.book, new.book"
+        yield table, "update", f"select book from {relation} where {col} = new.id"
+
+
+def is_books_view_materialized(db: Connection) -> bool:
+    return (
+        db.execute(
+            "select name from sqlite_master where name = 'BooksSummary'"
+        ).fetchone()
+        is not None
+    )
+
+
+def materialize_books_view(db: Connection, enable: bool = True) -> None:
+    """Replaces BooksView by a trigger maintained table with the same columns
+
+    Views then read the authors, genres and publishers of each book precomputed
+    instead of aggregating the relation tables on every query. Passing
+    `enable=False` restores the plain view.
+    """
+    if enable == is_books_view_materialized(db):
+        return
+
+    db.execute("begin")
+    with db:
+        db.execute("drop view BooksView")
+        if enable:
+            db.execute(
+                """create table BooksSummary(
+                    id INTEGER PRIMARY KEY, title, authors, genres, publishers,
+                    first_published, edition, isbn, notes, added)"""
+            )
+            db.execute(
+                f"insert into BooksSummary {_BOOK_SUMMARY_SELECT.format(cond='true')}"
+            )
+            for table, event, ids in _summary_triggers():
+                refresh = _BOOK_SUMMARY_SELECT.format(cond=f"Books.id in ({ids})")
+                db.execute(
+                    f"""create trigger BooksSummary{table}{event.capitalize()}
+                        after {event} on {table}
+                        begin
+                            insert or replace into BooksSummary {refresh};
+                        end"""
+                )
+            db.execute(
+                """create trigger BooksSummaryBooksDelete after delete on Books
+                   begin
+                       delete from BooksSummary where id = old.id;
+                   end"""
+            )
+            db.execute("create view BooksView as select * from BooksSummary")
+        else:
+            for (name,) in db.execute(
+                "select name from sqlite_master where type = 'trigger' and name like 'BooksSummary%'"
+            ).fetchall():
+                db.execute(f"drop trigger {name}")
+            db.execute("drop table BooksSummary")
+            db.execute(f"create view BooksView as {_BOOKS_VIEW_SELECT}")
+
+
 def init_db(db: Connection):
     def _def_col(att: attr.Attribute) -> str:
         if att.name == "id":
@@ -291,31 +535,91 @@ def init_db(db: Connection):
             cols = " , ".join(_def_col(att) for att in attr.fields(c))
             db.execute(f"CREATE TABLE {c.__name__}s({cols})")
 
+        db.execute(f"create view BooksView as {_BOOKS_VIEW_SELECT}")
+
+
+def _migrate_indexes(db: Connection) -> None:
+    for name, table, cols in [
+        ("BooksIsbn", "Books", "isbn"),
+        ("BooksTitle", "Books", "title"),
+        ("AuthorsName", "Authors", "name"),
+        ("GenresName", "Genres", "name"),
+        ("PublishersName", "Publishers", "name"),
+        ("ReadersName", "Readers", "name collate nocase"),
+        ("BookAuthorsBook", "BookAuthors", "book"),
+        ("BookAuthorsAuthor", "BookAuthors", "author"),
+        ("BookGenresBook", "BookGenres", "book"),
+        ("BookGenresGenre", "BookGenres", "genre"),
+        ("BookPublishersBook", "BookPublishers", "book"),
+        ("BookPublishersPublisher", "BookPublishers", "publisher"),
+        ("BookReadersBook", "BookReaders", "book"),
+        ("BookOwnersBook", "BookOwners", "book"),
+        ("WishlistsBook", "Wishlists", "book"),
+        # Covering indexes for the per user views shipped in qtbooks.cfg
+        ("BookReadersReader", "BookReaders", "reader, read, book, end, start"),
+        ("BookOwnersOwner", "BookOwners", "owner, book, place, loaned_to, loaned_from"),
+        ("WishlistsReader", "Wishlists", "reader, book, wishlisted"),
+    ]:
+        db.execute(f"create index if not exists {name} on {table}({cols})")
+
+
+SEARCH_COLUMNS = ("title", "authors", "genres", "publishers", "notes")
+
+
+def create_search_index(db: Connection) -> None:
+    """(Re)creates the full text index of the books, BooksSearch
+
+    The trigram tokenizer makes any search of at least 3 characters a case
+    insensitive substring match, the same semantics as plain filter terms.
+    """
+    db.execute("drop table if exists BooksSearch")
+    db.execute(
+        f"""create virtual table BooksSearch
+            using fts5({" , ".join(SEARCH_COLUMNS)}, tokenize = 'trigram')"""
+    )
+    db.execute(
+        f"""insert into BooksSearch(rowid, {" , ".join(SEARCH_COLUMNS)})
+            select id, {" , ".join(SEARCH_COLUMNS)}
+            from ({_BOOK_SUMMARY_SELECT.format(cond="true")})"""
+    )
+
+
+def has_search_index(db: Connection) -> bool:
+    return (
         db.execute(
-            """
-            create view BooksView as
-            select Books.id, title, Authors.authors, Genres.genres, Publishers.publishers, first_published, edition, isbn, notes, strftime('%%m/%%d/%%Y', added, 'unixepoch') as added
-            from Books left join
-                    (
-                    select b.id, group_concat(a.name) as authors
-                    from Books as b join BookAuthors as ba on b.id = ba.book
-                                    join Authors as a on ba.author = a.id
-                    group by b.id
-                    ) as Authors on Books.id = Authors.id left join
-                    (
-                    select b.id, group_concat(g.name) as genres
-                    from Books as b join BookGenres as bg on b.id = bg.book
-                                    join Genres as g on bg.genre = g.id
-                    group by b.id
-                    ) as Genres on Books.id = Genres.id left join
-                    (
-                    select b.id, group_concat(g.name) as publishers
-                    from Books as b join BookPublishers as bg on b.id = bg.book
-                                    join Publishers as g on bg.publisher = g.id
-                    group by b.id
-                    ) as Publishers on Books.id = Publishers.id
-            """
-        )
+            "select name from sqlite_master where name = 'BooksSearch'"
+        ).fetchone()
+        is not None
+    )
+
+
+def _migrate_search_index(db: Connection) -> None:
+    try:
+        create_search_index(db)
+    except sqlite.OperationalError as e:
+        logger.warning(f"Full text search not available in this SQLite build: {e}")
+
+
+# Each migration upgrades the schema by one version, tracked in the user_version
+# pragma. Append new migrations at the end and never modify already released ones.
+MIGRATIONS: List[Callable[[Connection], None]] = [
+    _migrate_indexes,
+    _migrate_search_index,
+]
+
+
+def migrate_db(db: Connection) -> None:
+    while True:
+        # The version is read in the transaction, in case another process is
+        # migrating the same database
+        db.execute("begin immediate")
+        with db:
+            version = db.execute("PRAGMA user_version").fetchone()[0]
+            if version >= len(MIGRATIONS):
+                break
+            logger.info(f"Migrating database to version {version + 1}")
+            MIGRATIONS[version](db)
+            db.execute(f"PRAGMA user_version = {version + 1}")
 
 
 def make_test_db(fn: str = ":memory:") -> Connection:
@@ -370,14 +674,172 @@ def make_test_db(fn: str = ":memory:") -> Connection:
     return db
 
 
+BOOK_TABLES = (
+    "Books",
+    "BookAuthors",
+    "BookGenres",
+    "BookPublishers",
+    "BookReaders",
+    "BookOwners",
+    "Wishlists",
+)
+BOOKS_VIEW_TABLES = (
+    "Books",
+    "BookAuthors",
+    "Authors",
+    "BookGenres",
+    "Genres",
+    "BookPublishers",
+    "Publishers",
+)
+
+
+def _tables_in(sql: str) -> Set[str]:
+    names = set(re.findall(r"\w+", sql))
+    tables = {f"{c.__name__}s" for c in TABLES} & names
+    if "BooksView" in names:
+        tables.update(BOOKS_VIEW_TABLES)
+    return tables
+
+
+def _deps_of(obj: TableI) -> List[Hashable]:
+    deps: List[Hashable] = [f"{obj.__class__.__name__}s"]
+    if isinstance(obj, Book):
+        deps.append(("book", obj.id))
+    elif isinstance(book := getattr(obj, "book", None), Book):
+        deps.append(("book", book.id))
+    return deps
+
+
+Entity = TypeVar("Entity", Author, Genre, Publisher, Reader)
+
+
+class EntityRegistry(object):
+    """Ids of the authors, genres, publishers and readers by name
+
+    Each table is loaded from the connection of the caller the first time it's
+    needed, and if given, every table is dropped when `stamp` returns a different
+    value, like the TableCache. Names are matched ignoring case and surrounding
+    spaces, so "Tolstoy" and "tolstoy " are the same author. Safe to share between
+    threads.
+    """
+
+    def __init__(self, stamp: Optional[Callable[[], Hashable]] = None) -> None:
+        self.stamp = stamp
+        self.last_stamp = None if stamp is None else stamp()
+        self.tables: Dict[type, Dict[str, Tuple[int, str]]] = {}
+        # Bumped on every change, so tables loaded meanwhile aren't stored
+        self.generation = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def key(name: str) -> str:
+        return name.strip().casefold()
+
+    def _table(self, db: Connection, cls: type) -> Dict[str, Tuple[int, str]]:
+        with self.lock:
+            if self.stamp is not None and (stamp := self.stamp()) != self.last_stamp:
+                self.last_stamp = stamp
+                self.tables = {}
+                self.generation += 1
+            if (table := self.tables.get(cls)) is not None:
+                return table
+            generation = self.generation
+        table = {}
+        for id, name in db.execute(f"select id, name from {cls.__name__}s order by id"):
+            # Names differing only in case stored before resolve to the first
+            table.setdefault(self.key(name), (id, name))
+        with self.lock:
+            if self.generation == generation:
+                self.tables[cls] = table
+        return table
+
+    def load(self, db: Connection, classes: Iterable[type]) -> None:
+        """Loads the tables of `classes` if they aren't already"""
+        for cls in classes:
+            self._table(db, cls)
+
+    def resolve(
+        self, db: Connection, cls: Type[Entity], names: Iterable[str]
+    ) -> List[Entity]:
+        """Entities of `cls` named `names`, without id for the names not stored"""
+        table = self._table(db, cls)
+        return [
+            cls(*found) if (found := table.get(self.key(name))) else cls(None, name)
+            for name in names
+        ]
+
+    def add(self, entities: Iterable[TableI]) -> None:
+        """Registers entities committed to the database"""
+        with self.lock:
+            for entity in entities:
+                if (table := self.tables.get(type(entity))) is not None:
+                    table.setdefault(self.key(entity.name), (entity.id, entity.name))
+            self.generation += 1
+
+    def clear(self) -> None:
+        with self.lock:
+            self.tables = {}
+            self.generation += 1
+
+
 class Controller(object):
-    def __init__(self, fn: str) -> None:
+    """Reads and writes the library in a database shared with other processes
+
+    With `lockfile`, the legacy mode for databases in network or synced folders,
+    where SQLite locking isn't reliable, only the first instance can write, and the
+    rest are read-only until its lockfile is removed. With `readonly`, the database
+    is opened read-only, without taking the lockfile.
+
+    A controller for another thread of the same process can be `shared` the cached
+    results and entities of an existing one, so the changes made through either
+    invalidate only the results they affect. Commits of other processes aren't
+    noticed then until check_external_changes is called.
+    """
+
+    def __init__(
+        self,
+        fn: str,
+        lockfile: bool = False,
+        readonly: bool = False,
+        wal: Optional[bool] = None,
+        shared: Optional["Controller"] = None,
+    ) -> None:
         # self.db = make_test_db(fn)
         abs_fn = Path(fn).expanduser().absolute()
-        self.db = create_db(str(abs_fn))
+        self.fn = str(abs_fn)
+        # Lockfile mode is meant for network or synced folders, where WAL is unsafe
+        self.wal = not lockfile if wal is None else wal
+        self.db = (
+            connect_readonly(self.fn) if readonly else create_db(self.fn, self.wal)
+        )
+        self.use_lockfile = lockfile and not readonly
         self.lockfile = abs_fn.parent / ".qtbooks.lock"
-        self.readonly = not self.acquire_lock()
+        self.readonly = readonly or (self.use_lockfile and not self.acquire_lock())
         self.user: Optional[Reader] = None
+        self.has_search_index = has_search_index(self.db)
+        if shared is None:
+            # Bounded by number of cached rows. Commits of other processes can't be
+            # tracked by table, so they drop every cached result
+            self.cache = TableCache(max_weight=500_000, stamp=self.data_version)
+            self.entities = EntityRegistry(stamp=self.data_version)
+        else:
+            # The data version of each connection changes with the commits of the
+            # others, so it can't tell them from those of other processes
+            self.cache, self.entities = shared.cache, shared.entities
+            self.cache.stamp = self.entities.stamp = None
+        self.checked_version = self.data_version()
+        # Invalidated again once the current transaction is committed
+        self.pending_deps: Set[Hashable] = set()
+        # Objects given an id by the current transaction, registered once it is
+        # committed or reset if it is rolled back
+        self.inserted_objs: List[TableI] = []
+        # Nesting level of transaction blocks, only the outermost one commits
+        self.transaction_depth = 0
+        self.listeners: List[Callable[[Set[int]], None]] = []
+        # Ids of the books written by the current transaction, notified once it is
+        # committed
+        self.pending_ids: Set[int] = set()
 
     def acquire_lock(self) -> bool:
         if self.lockfile.exists():
@@ -387,32 +849,98 @@ class Controller(object):
             return True
 
     def release_lock(self) -> None:
-        if not self.readonly:
+        if self.use_lockfile and not self.readonly:
             self.lockfile.unlink(missing_ok=True)
 
+    def data_version(self) -> int:
+        """Changes whenever another connection commits to the database"""
+        return self.db.execute("PRAGMA data_version").fetchone()[0]
+
+    def check_external_changes(self) -> bool:
+        """Whether another connection committed since the last check, dropping the
+        cached results if so
+
+        Only the changes of other processes are found when this is the controller
+        making every commit of the process.
+        """
+        if (version := self.data_version()) == self.checked_version:
+            return False
+        self.checked_version = version
+        self._invalidate_caches()
+        return True
+
     def execute(self, sql: str, *args, **kwargs) -> sqlite.Cursor:
         logger.debug(f"sql: {sql}")
         if self.readonly and not sql.lstrip()[:10].lower().startswith("select "):
             raise ValueError("Write query can't be executed on readonly database")
         return self.db.execute(sql, *args, **kwargs)
 
-    def change_user(self, user_name: str) -> None:
-        self.user = self.get_or_make_reader(user_name)
-        if self.user.id is None:
-            self._insert_obj(self.user)
-        self._invalidate_caches()
+    def add_listener(self, listener: Callable[[Set[int]], None]) -> None:
+        """Registers `listener` to be called with the ids of the books modified by
+        each write"""
+        self.listeners.append(listener)
 
-    @lru_cache
-    def get_view(self, view: config.View) -> Tuple[List[Row], List[str]]:
+    def _notify(self, ids: Iterable[int]) -> None:
+        ids = set(ids)
+        if self.transaction_depth > 0:
+            self.pending_ids.update(ids)
+            return
+        for listener in self.listeners:
+            listener(ids)
+
+    def change_user(self, user_name: str) -> None:
+        user = self.get_or_make_reader(user_name)
+        if user.id is None:
+            self.add_reader(user)
+        self.set_user(user)
+
+    def set_user(self, user: Optional[Reader]) -> None:
+        """Makes `user`, a reader already in the database, the current user"""
+        if user != self.user:
+            self.user = user
+            self._invalidate("user")
+
+    @cached(
+        lambda self, view, exp="": [*_tables_in(view.query), "user"],
+        weight=lambda value: len(value[0]) + 1,
+    )
+    def get_view(self, view: config.View, exp: str = "") -> Tuple[List[Row], List[str]]:
+        """Rows and header of `view`, only those matching the filter `exp` if given
+
+        The filter is compiled to SQL as far as possible and the rest is checked on
+        the rows returned by SQLite.
+        """
         if self.user is None:
             raise ValueError("Can't obtain view without a logged in user")
         sql = view.query.format(user=self.user.id)
-        cursor = self.execute(sql)
+        params: List = []
+        residual = None
+        if exp != "":
+            columns = [
+                t[0] for t in self.execute(f"select * from ({sql}) limit 0").description
+            ]
+            where, params, residual = compile_filter(
+                exp, columns, self.has_search_index
+            )
+            sql = f"select * from ({sql}) where {where}"
+        cursor = self.execute(sql, params)
         rows = cursor.fetchall()
         header = [t[0] for t in cursor.description]
+        if residual is not None:
+            rows = [row for row in rows if residual.matches(row)]
         return rows, header
 
-    @lru_cache
+    def get_view_books(self, view: config.View, ids: Iterable[int]) -> List[Row]:
+        """Rows of `view` concerning the books with the given ids"""
+        if self.user is None:
+            raise ValueError("Can't obtain view without a logged in user")
+        sql = view.query.format(user=self.user.id)
+        return self.execute(
+            f"select * from ({sql}) where id in (select value from json_each(?))",
+            [json.dumps(list(ids))],
+        ).fetchall()
+
+    @cached(lambda self: BOOKS_VIEW_TABLES, weight=lambda value: len(value) + 1)
     def get_all_books(self) -> List[Row]:
         rows = self.execute(
             """
@@ -423,7 +951,7 @@ class Controller(object):
 
         return rows
 
-    @lru_cache
+    @cached(lambda self, isbn: BOOK_TABLES)
     def get_book_isbn(self, isbn: str) -> Book:
         try:
             book_row = self.execute(
@@ -435,7 +963,7 @@ class Controller(object):
             raise ValueError(f"No book found with isbn {isbn}")
         return self.get_book(book_row["id"])
 
-    @lru_cache
+    @cached(lambda self, title: BOOK_TABLES)
     def get_books_title(self, title: str) -> List[Book]:
         try:
             book_rows = self.execute(
@@ -443,252 +971,615 @@ class Controller(object):
             ).fetchall()
         except Exception as e:
             raise e
-        return [self.get_book(row["id"]) for row in book_rows]
+        return self.get_books([row["id"] for row in book_rows])
 
-    @lru_cache
+    @cached(lambda self, id: [("book", id)])
     def get_book(self, id: int) -> Book:
         logger.debug(f"Getting book {id}")
+        books = self.get_books([id])
+        if len(books) == 0:
+            raise ValueError(f"No book found with id {id}")
+        return books[0]
+
+    def get_books(self, ids: Iterable[int]) -> List[Book]:
+        """Books with the given ids, in the same order, skipping missing ones
+
+        Every book is fully hydrated with its relations using a fixed number of
+        queries, independent of the number of books.
+        """
+        ids = list(ids)
+        id_json = json.dumps(ids)
+
+        def grouped(sql: str) -> Dict[int, List[Row]]:
+            groups: Dict[int, List[Row]] = {id: [] for id in books}
+            for row in self.execute(sql, [id_json]):
+                groups[row["book"]].append(row)
+            return groups
+
+        book_rows = self.execute(
+            "select * from Books where id in (select value from json_each(?))",
+            [id_json],
+        ).fetchall()
+        books = {row["id"]: Book(**row) for row in book_rows}
+        author_rows = grouped(
+            """select BookAuthors.id as id, book, Authors.id as author_id, name
+            from BookAuthors join Authors on BookAuthors.author = Authors.id
+            where BookAuthors.book in (select value from json_each(?))
+            order by BookAuthors.id"""
+        )
+        genre_rows = grouped(
+            """select BookGenres.id as id, book, Genres.id as genre_id, name
+            from BookGenres join Genres on BookGenres.genre = Genres.id
+            where BookGenres.book in (select value from json_each(?))
+            order by BookGenres.id"""
+        )
+        publisher_rows = grouped(
+            """select BookPublishers.id as id, book, Publishers.id as publisher_id, name
+            from BookPublishers join Publishers on BookPublishers.publisher = Publishers.id
+            where BookPublishers.book in (select value from json_each(?))
+            order by BookPublishers.id"""
+        )
+        reading_rows = grouped(
+            """select BookReaders.id as id, book, Readers.id as reader_id, name,
+                      start, end, dropped, read, notes, rating
+            from BookReaders join Readers on BookReaders.reader = Readers.id
+            where BookReaders.book in (select value from json_each(?))
+            order by BookReaders.id"""
+        )
+        owner_rows = grouped(
+            """select BookOwners.id as id, book, Readers.id as owner_id, name,
+                      place, loaned_to, loaned_from
+            from BookOwners join Readers on BookOwners.owner = Readers.id
+            where BookOwners.book in (select value from json_each(?))
+            order by BookOwners.id"""
+        )
+        wishlist_rows = grouped(
+            """select Wishlists.id as id, book, Readers.id as reader_id, name, wishlisted
+            from Wishlists join Readers on Wishlists.reader = Readers.id
+            where Wishlists.book in (select value from json_each(?))
+            order by Wishlists.id"""
+        )
 
-        try:
-            book_row = self.execute("select * from Books where id = ?", [id]).fetchone()
-            author_rows = self.execute(
-                """select BookAuthors.id as id,
-                          json_object('id', Authors.id, 'name', name) as author
-                from BookAuthors join Authors on BookAuthors.author = Authors.id
-                where BookAuthors.book = ?""",
-                [id],
-            ).fetchall()
-            genre_rows = self.execute(
-                """select BookGenres.id as id,
-                          json_object('id', Genres.id, 'name', name) as genre
-                from BookGenres join Genres on BookGenres.genre = Genres.id
-                where BookGenres.book = ?""",
-                [id],
-            ).fetchall()
-            publisher_rows = self.execute(
-                """select BookPublishers.id as id,
-                          json_object('id', Publishers.id, 'name', name) as publisher
-                from BookPublishers join Publishers on BookPublishers.publisher = Publishers.id
-                where BookPublishers.book = ?""",
-                [id],
-            ).fetchall()
-            reading_rows = self.execute(
-                """select BookReaders.id as id,
-                          json_object('id', Readers.id, 'name', name) as reader,
-                          start, end, dropped, read, notes, rating
-                from BookReaders join Readers on BookReaders.reader = Readers.id
-                where BookReaders.book = ?""",
-                [id],
-            ).fetchall()
-            owner_rows = self.execute(
-                """select BookOwners.id as id,
-                          json_object('id', Readers.id, 'name', name) as owner,
-                          place, loaned_to, loaned_from
-                from BookOwners join Readers on BookOwners.owner = Readers.id
-                where BookOwners.book = ?""",
-                [id],
-            ).fetchall()
-            wishlist_rows = self.execute(
-                """select Wishlists.id as id, wishlisted,
-                          json_object('id', Readers.id, 'name', name) as reader
-                from Wishlists join Readers on Wishlists.reader = Readers.id
-                where Wishlists.book = ?""",
-                [id],
-            ).fetchall()
-        except Exception as e:
-            raise e
-        book = Book(**book_row)
-        logger.debug(f"{len(author_rows)}")
-
-        book.authors = [BookAuthor(book=book, **row) for row in author_rows]
-        book.genres = [BookGenre(book=book, **row) for row in genre_rows]
-        book.publishers = [BookPublisher(book=book, **row) for row in publisher_rows]
-        book.readings = [BookReader(book=book, **row) for row in reading_rows]
-        book.owners = [BookOwner(book=book, **row) for row in owner_rows]
-        book.wishlists = [Wishlist(book=book, **row) for row in wishlist_rows]
-        book.has_dirty_relations = False
-        return book
+        for id, book in books.items():
+            book.authors = [
+                BookAuthor(r["id"], book, Author(r["author_id"], r["name"]))
+                for r in author_rows[id]
+            ]
+            book.genres = [
+                BookGenre(r["id"], book, Genre(r["genre_id"], r["name"]))
+                for r in genre_rows[id]
+            ]
+            book.publishers = [
+                BookPublisher(r["id"], book, Publisher(r["publisher_id"], r["name"]))
+                for r in publisher_rows[id]
+            ]
+            book.readings = [
+                BookReader(
+                    r["id"],
+                    Reader(r["reader_id"], r["name"]),
+                    book,
+                    r["start"],
+                    r["end"],
+                    r["read"],
+                    r["dropped"],
+                    r["rating"],
+                    r["notes"],
+                )
+                for r in reading_rows[id]
+            ]
+            book.owners = [
+                BookOwner(
+                    r["id"],
+                    book,
+                    Reader(r["owner_id"], r["name"]),
+                    r["place"],
+                    r["loaned_to"],
+                    r["loaned_from"],
+                )
+                for r in owner_rows[id]
+            ]
+            book.wishlists = [
+                Wishlist(r["id"], r["wishlisted"], Reader(r["reader_id"], r["name"]), book)
+                for r in wishlist_rows[id]
+            ]
+            book.clear_changes()
+
+        return [books[id] for id in ids if id in books]
 
     def get_or_make_reader(self, name: str) -> Reader:
-        row = self.execute(
-            "select * from Readers where name = ? collate nocase", [name]
-        ).fetchone()
-        if row is None:
-            reader = Reader(None, name)
-        else:
-            reader = Reader(**row)
-        return reader
+        return self.entities.resolve(self.db, Reader, [name])[0]
+
+    def make_book_authors(self, book: Book, names: Iterable[str]) -> List[BookAuthor]:
+        return [
+            BookAuthor(None, book=book, author=author)
+            for author in self.entities.resolve(self.db, Author, names)
+        ]
+
+    def make_book_genres(self, book: Book, names: Iterable[str]) -> List[BookGenre]:
+        return [
+            BookGenre(None, book=book, genre=genre)
+            for genre in self.entities.resolve(self.db, Genre, names)
+        ]
+
+    def make_book_publishers(
+        self, book: Book, names: Iterable[str]
+    ) -> List[BookPublisher]:
+        return [
+            BookPublisher(None, book=book, publisher=publisher)
+            for publisher in self.entities.resolve(self.db, Publisher, names)
+        ]
 
     def get_or_make_book_author(self, book: Book, name: str) -> BookAuthor:
-        row = self.execute("select * from Authors where name = ?", [name]).fetchone()
-        if row is None:
-            author = Author(None, name)
-        else:
-            author = Author(**row)
-        return BookAuthor(None, book=book, author=author)
+        return self.make_book_authors(book, [name])[0]
 
     def get_or_make_book_genre(self, book: Book, name: str) -> BookGenre:
-        row = self.execute("select * from Genres where name = ?", [name]).fetchone()
-        if row is None:
-            genre = Genre(None, name)
-        else:
-            genre = Genre(**row)
-        return BookGenre(None, book=book, genre=genre)
+        return self.make_book_genres(book, [name])[0]
 
     def get_or_make_book_publisher(self, book: Book, name: str) -> BookPublisher:
-        row = self.execute("select * from Publishers where name = ?", [name]).fetchone()
-        if row is None:
-            publisher = Publisher(None, name)
-        else:
-            publisher = Publisher(**row)
-        return BookPublisher(None, book=book, publisher=publisher)
+        return self.make_book_publishers(book, [name])[0]
 
-    @lru_cache
+    def load_entities(self) -> None:
+        """Loads every author, genre, publisher and reader, so resolving their names
+        doesn't query the database"""
+        self.entities.load(self.db, [Author, Genre, Publisher, Reader])
+
+    @cached(lambda self: ["Authors"])
     def get_all_authors(self) -> List[str]:
         return [r["name"] for r in self.execute("select name from Authors")]
 
-    @lru_cache
+    @cached(lambda self: ["Genres"])
     def get_all_genres(self) -> List[str]:
         return [r["name"] for r in self.execute("select name from Genres")]
 
-    @lru_cache
+    @cached(lambda self: ["Publishers"])
     def get_all_publishers(self) -> List[str]:
         return [r["name"] for r in self.execute("select name from Publishers")]
 
-    @lru_cache
+    @cached(lambda self: ["Readers"])
     def get_all_readers(self) -> List[str]:
         return [r["name"].lower() for r in self.execute("select name from Readers")]
 
+    def _invalidate(self, *deps: Hashable) -> None:
+        """Invalidates the cached results depending on any of `deps`
+
+        Dependencies are table names, ("book", id) for everything concerning a
+        single book, or "user" for results depending on the current user.
+        """
+        self.cache.invalidate(*deps)
+        if self.db.in_transaction:
+            # Results cached meanwhile through other connections may predate the
+            # commit
+            self.pending_deps.update(deps)
+
     def _invalidate_caches(self) -> None:
-        for method_name in dir(self):
-            if not method_name.startswith("_") and hasattr(
-                (method := getattr(self, method_name)), "cache_clear"
-            ):
-                method.cache_clear()
+        self.cache.clear()
+        self.entities.clear()
+
+    @contextlib.contextmanager
+    def transaction(self) -> Iterator[None]:
+        """Commits the statements run in the block, or rolls them back if it raises
+
+        Blocks can be nested, and the writes of the inner ones, like those of the
+        methods adding books, are only committed with the outermost one. The
+        objects inserted in a rolled back block get their id of None back, so
+        saving them can be retried.
+        """
+        if self.transaction_depth > 0:
+            self.transaction_depth += 1
+            try:
+                yield
+            finally:
+                self.transaction_depth -= 1
+            return
+        self.transaction_depth = 1
+        try:
+            with self.db:
+                yield
+        except BaseException:
+            for obj in self.inserted_objs:
+                obj.id = None
+            self.inserted_objs.clear()
+            self.pending_ids.clear()
+            raise
+        finally:
+            self.transaction_depth = 0
+            self.cache.invalidate(*self.pending_deps)
+            self.pending_deps.clear()
+        self.entities.add(
+            [
+                obj
+                for obj in self.inserted_objs
+                if isinstance(obj, (Author, Genre, Publisher, Reader))
+            ]
+        )
+        self.inserted_objs.clear()
+        ids, self.pending_ids = self.pending_ids, set()
+        if len(ids) > 0:
+            self._notify(ids)
+
+    def materialize_books_view(self, enable: bool = True) -> None:
+        if self.readonly:
+            raise ValueError("Can't change the schema of a readonly database")
+        materialize_books_view(self.db, enable)
+        self._invalidate_caches()
+
+    def rebuild_search_index(self) -> None:
+        if self.readonly:
+            raise ValueError("Can't rebuild the index of a readonly database")
+        with self.db:
+            create_search_index(self.db)
+        self.has_search_index = True
+
+    def _index_books(self, ids: List[int]) -> None:
+        if not self.has_search_index:
+            return
+        # The ids are bound as a JSON array, so the statements are always the same
+        id_list = json.dumps([int(id) for id in ids])
+        ids_in = "in (select value from json_each(?))"
+        self.execute(f"delete from BooksSearch where rowid {ids_in}", [id_list])
+        self.execute(
+            f"""insert into BooksSearch(rowid, {" , ".join(SEARCH_COLUMNS)})
+                select id, {" , ".join(SEARCH_COLUMNS)}
+                from ({_BOOK_SUMMARY_SELECT.format(cond=f"Books.id {ids_in}")})""",
+            [id_list],
+        )
 
     def update_book(self, book: Book) -> None:
-        if book.has_dirty_relations:
-            with self.db:
-                self.delete_book(book)
-                self.add_book(book)
-            book.has_dirty_relations = False
-        else:
-            with self.db:
-                self.execute(
-                    f"""
-                    update Books set ({" , ".join(book.columns())}) = ({" , ".join(book.values())})
-                    where id = {book.id}
-                    """
+        """Saves the changes to `book`
+
+        Only the relations added to or removed from it are inserted or deleted, the
+        rest are updated in place, so the book and its relations keep their ids.
+        """
+        deps: Set[Hashable] = {"Books", "BookReaders", "BookOwners", ("book", book.id)}
+        with self.transaction():
+            self.execute(_statements(Book).update, _update_params(book))
+            for cls, objs in [(BookReader, book.readings), (BookOwner, book.owners)]:
+                self.db.executemany(
+                    _statements(cls).update,
+                    [_update_params(obj) for obj in objs if obj.id is not None],
                 )
-                if len(book.readings) > 0:
-                    for reading in book.readings:
-                        self.execute(
-                            f"""
-                            update BookReaders set ({" , ".join(reading.columns())}) = ({" , ".join(reading.values())})
-                            where id = {reading.id}
-                            """
-                        )
-                if len(book.owners) > 0:
-                    for owner in book.owners:
-                        self.execute(
-                            f"""
-                            update BookOwners set ({" , ".join(owner.columns())}) = ({" , ".join(owner.values())})
-                            where id = {owner.id}
-                            """
-                        )
-
-        self._invalidate_caches()
+            if book.has_dirty_relations:
+                for name, relations in zip(RELATIONS, book.relation_lists()):
+                    for obj in relations.removed:
+                        self.execute(_statements(obj.__class__).delete, [obj.id])
+                        deps.update(_deps_of(obj))
+                    if (entity := RELATIONS[name]) is not None:
+                        self._insert_relations(relations.added, entity)
+                    else:
+                        self._insert_objs(relations.added)
+            self._index_books([book.id])
+        book.clear_changes()
+        self._invalidate(*deps)
+        self._notify([book.id])
 
     def delete_book(self, book: Book) -> None:
         self.execute("delete from Books where id = ?", [book.id])
+        self._index_books([book.id])
         self.db.commit()
-        self._invalidate_caches()
+        self._invalidate(*BOOK_TABLES, ("book", book.id))
+        self._notify([book.id])
 
     def add_book(self, book: Book) -> None:
-        with self.db:
-            self._insert_obj(book)
-            for author in book.authors:
-                self.add_book_author(author)
-            for genre in book.genres:
-                self.add_book_genre(genre)
-            for publisher in book.publishers:
-                self.add_book_publisher(publisher)
-            for reading in book.readings:
-                self._insert_obj(reading)
-            for owner in book.owners:
-                self._insert_obj(owner)
-            for wishlist in book.wishlists:
-                self._insert_obj(wishlist)
+        self.add_books([book])
+
+    def add_books(self, books: Iterable[Book]) -> None:
+        """Adds the books and all their relations in a single transaction
+
+        New authors, genres and publishers shared by several books are only
+        inserted once.
+        """
+        books = list(books)
+        with self.transaction():
+            self._insert_objs(books)
+            for relations, entity in RELATIONS.items():
+                items = [item for book in books for item in getattr(book, relations)]
+                if entity is not None:
+                    self._insert_relations(items, entity)
+                else:
+                    self._insert_objs(items)
+            self._index_books([book.id for book in books])
+        for book in books:
+            book.clear_changes()
+        self._notify(book.id for book in books)
+
+    def add_book_genres(self, items: Iterable[BookGenre]) -> None:
+        """Adds genres to existing books in a single transaction"""
+        self._add_relations(list(items), "genre")
+
+    def _add_relations(
+        self, items: Sequence[Union[BookAuthor, BookGenre, BookPublisher]], entity: str
+    ) -> None:
+        """Adds relations of the same class to existing books in a single
+        transaction, with their new `entity` objects"""
+        with self.transaction():
+            self._insert_relations(items, entity)
+            self._index_books(list({item.book.id for item in items}))
+        self._notify(item.book.id for item in items)
+
+    def _insert_relations(self, items: Sequence[TableI], entity: str) -> None:
+        """Inserts relations of the same class and their new `entity` objects
+        without committing, inserting entities shared by several items once"""
+        new: Dict[str, List[TableI]] = {}
+        for item in items:
+            if (obj := getattr(item, entity)).id is None:
+                new.setdefault(EntityRegistry.key(obj.name), []).append(obj)
+        self._insert_objs([objs[0] for objs in new.values()])
+        for objs in new.values():
+            for obj in objs[1:]:
+                obj.id = objs[0].id
+            self.inserted_objs.extend(objs[1:])
+        self._insert_objs(items)
 
     def add_book_author(self, item: BookAuthor) -> None:
-        with self.db:
-            if item.author.id is None:
-                self._insert_obj(item.author)
-            self._insert_obj(item)
+        self._add_relations([item], "author")
 
     def add_book_genre(self, item: BookGenre) -> None:
-        with self.db:
-            if item.genre.id is None:
-                self._insert_obj(item.genre)
-            self._insert_obj(item)
+        self._add_relations([item], "genre")
 
     def add_book_publisher(self, item: BookPublisher) -> None:
-        with self.db:
-            if item.publisher.id is None:
-                self._insert_obj(item.publisher)
-            self._insert_obj(item)
+        self._add_relations([item], "publisher")
 
     def add_reader(self, item: Reader) -> None:
-        with self.db:
-            self._insert_obj(item)
-
-    def _insert_obj(self, obj: TableI):
-        # query = f"""insert into {obj.__class__.__name__}s values ({" , ".join(obj.values())}) returning id"""
-        query = f"""insert into {obj.__class__.__name__}s ({" , ".join(obj.columns())})
-                    values ({" , ".join(obj.values())})"""
-        # id = self.execute(query).fetchone()[0]
-        self.execute(query)
-        idquery = f"""select id from {obj.__class__.__name__}s
-                      where {" and ".join(
-                        f"{col} = {val}"
-                        for col, val in zip(obj.columns(), obj.values())
-                        if col != "id")}
-                      order by id desc"""
-        id = self.execute(idquery).fetchone()[0]
-        obj.id = int(id)
-        self.db.commit()
-        self._invalidate_caches()
+        with self.transaction():
+            self._insert_objs([item])
+
+    def _insert_objs(self, objs: Sequence[TableI]) -> None:
+        """Inserts objects of the same class without committing, setting their ids"""
+        if len(objs) == 0:
+            return
+        query = _statements(objs[0].__class__).insert
+        # executemany can't report the id of each row, so the cached statement is
+        # run for each object instead
+        deps: Set[Hashable] = set()
+        for obj in objs:
+            obj.id = self.execute(query, obj.params()).lastrowid
+            self.inserted_objs.append(obj)
+            deps.update(_deps_of(obj))
+        self._invalidate(*deps)
+
+
+_REGEX_CHARS = frozenset(".^$*+?{}[]\\|()")
+
+
+def _is_regex(pattern: str) -> bool:
+    return any(c in _REGEX_CHARS for c in pattern)
+
+
+# Separates the columns of a row in the strings of a SearchIndex. Filter terms
+# can't contain it, and . doesn't match it, so most matches can't span columns
+FIELD_SEP = "\n"
+
+# Escapes, negated classes and inline flags or lookarounds may match FIELD_SEP or
+# depend on what surrounds the column
+_SPANNING_REGEX = re.compile(r"\\|\[\^|\(\?")
+
+
+class SearchIndex(object):
+    """Lowered strings of the columns of some rows, built once to match filters
+
+    `texts` holds the columns of each row joined by FIELD_SEP, for unqualified
+    plain terms, and `columns` the strings of each column. The patching methods
+    return a new index, so filters running on another thread keep a consistent one.
+    """
+
+    def __init__(
+        self, header: List[str], columns: List[List[str]], texts: List[str]
+    ) -> None:
+        self.header = header
+        self.columns = dict(zip(header, columns))
+        self.texts = texts
+
+    @staticmethod
+    def build(rows: List[Row], header: List[str]) -> "SearchIndex":
+        strings = [[f"{v}".lower() for v in row] for row in rows]
+        columns = [list(col) for col in zip(*strings)] or [[] for _ in header]
+        return SearchIndex(header, columns, [FIELD_SEP.join(s) for s in strings])
+
+    def __len__(self) -> int:
+        return len(self.texts)
+
+    def replace(self, i: int, row: Row) -> "SearchIndex":
+        strings = [f"{v}".lower() for v in row]
+        return SearchIndex(
+            self.header,
+            [
+                col[:i] + [s] + col[i + 1 :]
+                for col, s in zip(self.columns.values(), strings)
+            ],
+            self.texts[:i] + [FIELD_SEP.join(strings)] + self.texts[i + 1 :],
+        )
+
+    def remove(self, i: int) -> "SearchIndex":
+        return SearchIndex(
+            self.header,
+            [col[:i] + col[i + 1 :] for col in self.columns.values()],
+            self.texts[:i] + self.texts[i + 1 :],
+        )
+
+    def append(self, rows: List[Row]) -> "SearchIndex":
+        other = SearchIndex.build(rows, self.header)
+        return SearchIndex(
+            self.header,
+            [
+                col + other_col
+                for col, other_col in zip(
+                    self.columns.values(), other.columns.values()
+                )
+            ],
+            self.texts + other.texts,
+        )
+
+
+_YMD_DATE = re.compile(r"(\d{4})/(\d{2})/(\d{2})$")
+_MDY_DATE = re.compile(r"(\d{2})/(\d{2})/(\d{4})$")
+
+
+def sort_key(value: Any) -> Tuple:
+    """Key ordering the values of a column by their type
+
+    Nulls go first, then numbers, then dates formatted by the views, by date, and
+    then any other text, ignoring case.
+    """
+    if value is None:
+        return (0,)
+    if isinstance(value, (int, float)):
+        return (1, value)
+    text = f"{value}"
+    if text[:1].isdigit():
+        if (match := _YMD_DATE.match(text)) is not None:
+            return (2, match.group(1, 2, 3))
+        if (match := _MDY_DATE.match(text)) is not None:
+            return (2, match.group(3, 1, 2))
+    return (3, text.casefold())
 
 
 class RowFilter(object):
-    def __init__(self, exp: str) -> None:
+    def __init__(
+        self, exp: str, tokens: Optional[List[Tuple[str, str]]] = None
+    ) -> None:
         self.exp = exp
         self.regexes: Dict[str, List[re.Pattern]] = dict()
-        for k, v in split_tokens(exp):
+        # (column, lowered term) of the terms matched as plain substrings
+        self.plain: List[Tuple[str, str]] = []
+        # Regexes to match against the lowered strings of a SearchIndex: one for the
+        # columns and, if possible, one for the joined columns of a row, which finds
+        # the same rows, or a superset if the regex has anchors
+        self.index_regexes: List[Tuple[str, re.Pattern, Optional[re.Pattern]]] = []
+        for k, v in split_tokens(exp) if tokens is None else tokens:
+            if not _is_regex(v):
+                self.plain.append((k, v.lower()))
+                continue
             self.regexes.setdefault(k, []).append(re.compile(v, re.IGNORECASE))
+            if _SPANNING_REGEX.search(v) is None:
+                # Only literals and classes, lowering it is enough to ignore case
+                self.index_regexes.append(
+                    (k, re.compile(v.lower()), re.compile(v.lower(), re.MULTILINE))
+                )
+            else:
+                self.index_regexes.append((k, re.compile(v, re.IGNORECASE), None))
 
     def matches(self, row: Row) -> bool:
-        if "" in self.regexes:
-            for regex in self.regexes[""]:
-                match = False
-                for v in row:
-                    if regex.search(f"{v}") is not None:
-                        match = True
-                        break
-                if not match:
-                    return False
-
-        for k, v in self.regexes.items():
+        for k, v in self.plain:
             if k == "":
-                continue
-            if k not in row.keys():
+                if not any(v in f"{value}".lower() for value in row):
+                    return False
+            elif k not in row.keys() or v not in f"{row[k]}".lower():
                 return False
-            for regex in v:
-                if regex.search(f"{row[k]}") is None:
+
+        for k, regexes in self.regexes.items():
+            for regex in regexes:
+                if k == "":
+                    if not any(regex.search(f"{value}") for value in row):
+                        return False
+                elif k not in row.keys() or regex.search(f"{row[k]}") is None:
                     return False
 
         return True
 
+    def implies(self, other: "RowFilter") -> bool:
+        """Whether every row matching this filter is known to match `other` too
+
+        That's the case when each term of `other` is a term of this filter, or a
+        plain term contained in one of this filter on the same column, or on any
+        column if the term of `other` is unqualified.
+        """
+        for k, v in other.plain:
+            if not any(
+                v in v2 and (k == k2 or k == "") for k2, v2 in self.plain
+            ):
+                return False
+        for k, regexes in other.regexes.items():
+            if any(regex not in self.regexes.get(k, []) for regex in regexes):
+                return False
+        return True
+
+    def match_index(
+        self, index: SearchIndex, rows: Optional[Iterable[int]] = None
+    ) -> List[int]:
+        """Indices of the rows of `index` that match, among `rows` if given"""
+        candidates: Iterable[int] = range(len(index)) if rows is None else rows
+        for k, v in self.plain:
+            strings = index.texts if k == "" else index.columns.get(k)
+            if strings is None:
+                return []
+            candidates = [i for i in candidates if v in strings[i]]
+
+        for k, regex, row_regex in self.index_regexes:
+            search = regex.search
+            if k != "":
+                if (strings := index.columns.get(k)) is None:
+                    return []
+                candidates = [i for i in candidates if search(strings[i])]
+                continue
+            if row_regex is not None:
+                search_row, texts = row_regex.search, index.texts
+                candidates = [i for i in candidates if search_row(texts[i])]
+                if "^" not in regex.pattern and "$" not in regex.pattern:
+                    continue
+            # Checked column by column, a match must not span several
+            columns = list(index.columns.values())
+            candidates = [
+                i for i in candidates if any(search(col[i]) for col in columns)
+            ]
+
+        return list(candidates)
+
+
+def _like_pattern(pattern: str) -> Optional[str]:
+    """LIKE pattern equivalent to searching the regex `pattern`, if there's one"""
+    prefix = pattern.startswith("^")
+    suffix = pattern.endswith("$") and not pattern.endswith("\\$")
+    core = pattern[1 if prefix else 0 : -1 if suffix else None]
+    # LIKE is only case insensitive for ASCII characters
+    if _is_regex(core) or not core.isascii():
+        return None
+    core = core.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    return f"{'' if prefix else '%'}{core}{'' if suffix else '%'}"
+
+
+def _quote(identifier: str) -> str:
+    return '"{}"'.format(identifier.replace('"', '""'))
+
+
+def compile_filter(
+    exp: str, columns: List[str], search_index: bool = False
+) -> Tuple[str, List[str], Optional[RowFilter]]:
+    """Compiles the filter expression `exp` into a SQL where clause
+
+    Returns the clause and its parameters, to be applied to a query with the given
+    columns, and a RowFilter with the terms that can't be expressed in SQL, or None
+    if every term could. When `search_index` is True, plain unqualified terms are
+    looked up in BooksSearch for the SEARCH_COLUMNS.
+    """
+    conds: List[str] = []
+    params: List[str] = []
+    residual: List[Tuple[str, str]] = []
+    for k, v in split_tokens(exp):
+        like = _like_pattern(v)
+        if like is None:
+            residual.append((k, v))
+            continue
+        if k != "" and k not in columns:
+            conds.append("false")
+            continue
+
+        cols = columns if k == "" else [k]
+        col_conds = []
+        anchored = v.startswith("^") or v.endswith("$")
+        if k == "" and search_index and "id" in columns and not anchored and len(v) >= 3:
+            col_conds.append(
+                '"id" in (select rowid from BooksSearch where BooksSearch match ?)'
+            )
+            params.append('"{}"'.format(v.replace('"', '""')))
+            cols = [c for c in cols if c not in SEARCH_COLUMNS]
+        for c in cols:
+            col_conds.append(f"{_quote(c)} like ? escape '\\'")
+            params.append(like)
+        conds.append(f"({' or '.join(col_conds) or 'false'})")
+
+    where = " and ".join(conds) or "true"
+    return where, params, RowFilter(exp, tokens=residual) if residual else None
+
 
 def split_tokens(exp: str) -> Iterator[Tuple[str, str]]:
     exp = exp + " "
@@ -760,3 +1651,186 @@ def test_split_tokens() -> None:
 
     exp = '"foo:bar":"bar foo"'
     assert list(split_tokens(exp)) == [("foo:bar", "bar foo")]
+
+
+def test_compile_filter() -> None:
+    columns = ["id", "title", "rating"]
+
+    where, params, residual = compile_filter("title:^war", columns)
+    assert where == """("title" like ? escape '\\')"""
+    assert params == ["war%"]
+    assert residual is None
+
+    where, params, residual = compile_filter("10% t.*y", columns)
+    assert params == ["%10\\%%"] * 3
+    assert residual is not None and list(residual.regexes) == [""]
+
+    where, params, residual = compile_filter("foo:bar", columns)
+    assert where == "false"
+
+
+def test_row_filter_index() -> None:
+    db = sqlite.connect(":memory:")
+    db.row_factory = sqlite.Row
+    db.execute("create table T(title, authors, notes)")
+    db.executemany(
+        "insert into T values (?, ?, ?)",
+        [
+            ("War and Peace", "Tolstoy", "first\nwar"),
+            ("Peace", "War, Tolstoy", None),
+            ("Tol", "Stoy", ""),
+        ],
+    )
+    rows = db.execute("select * from T").fetchall()
+    index = SearchIndex.build(rows, ["title", "authors", "notes"])
+    for exp in ["tol", "^war", "notes:^war", "tol.*stoy", "tol\\s*stoy", "none", "x:y"]:
+        row_filter = RowFilter(exp)
+        expected = [i for i, row in enumerate(rows) if row_filter.matches(row)]
+        assert row_filter.match_index(index) == expected, exp
+        assert row_filter.match_index(index, [1, 2]) == [i for i in expected if i]
+
+
+def test_statements() -> None:
+    assert _statements(Reader) is _statements(Reader)
+    db = sqlite.connect(":memory:")
+    db.execute("create table Readers(id INTEGER PRIMARY KEY, name)")
+    reader = Reader(3, "O'Brien")
+    db.execute(_statements(Reader).insert, reader.params())
+    assert db.execute("select id, name from Readers").fetchall() == [(3, "O'Brien")]
+    reader.name = "Fran"
+    db.execute(_statements(Reader).update, _update_params(reader))
+    assert db.execute("select id, name from Readers").fetchall() == [(3, "Fran")]
+
+
+def test_relation_list_changes() -> None:
+    book = Book(1, "Title", 2000, 1, datetime.date(2020, 1, 1), "", "")
+    dropped = BookAuthor(2, book, Author(2, "B"))
+    book.authors = [BookAuthor(1, book, Author(1, "A")), dropped]
+    book.clear_changes()
+    book.authors = [
+        BookAuthor(None, book, Author(1, "A")),
+        BookAuthor(None, book, Author(None, "C")),
+    ]
+    assert book.has_dirty_relations
+    assert book.authors[0].id == 1
+    assert book.authors.removed == [dropped]
+    assert [item.author.name for item in book.authors.added] == ["C"]
+    book.authors.remove(book.authors[1])
+    assert book.authors.added == []
+    book.authors.append(dropped)
+    assert book.authors.removed == []
+    del book.authors[-1]
+    book.owners.extend([BookOwner(None, book, Reader(1, "a"), "", "", "")])
+    assert book.authors.removed == [dropped]
+    assert len(book.owners.added) == 1
+    book.clear_changes()
+    book.authors.clear()
+    assert [item.id for item in book.authors.removed] == [1]
+
+
+def test_entity_registry() -> None:
+    db = sqlite.connect(":memory:")
+    db.execute("create table Authors(id INTEGER PRIMARY KEY, name)")
+    db.executemany("insert into Authors(name) values (?)", [("Tolstoy",), ("tolstoy",)])
+    version = 0
+    registry = EntityRegistry(stamp=lambda: version)
+    assert registry.resolve(db, Author, ["TOLSTOY ", "Chekhov"]) == [
+        Author(1, "Tolstoy"),
+        Author(None, "Chekhov"),
+    ]
+    registry.add([Author(3, "Chekhov")])
+    assert registry.resolve(db, Author, ["chekhov"]) == [Author(3, "Chekhov")]
+    db.execute("insert into Authors(name) values ('Gogol')")
+    assert registry.resolve(db, Author, ["Gogol"]) == [Author(None, "Gogol")]
+    version += 1
+    assert registry.resolve(db, Author, ["Gogol"]) == [Author(3, "Gogol")]
+
+
+def test_shared_controllers(tmp_path: Path) -> None:
+    fn = str(tmp_path / "books.sqlite")
+    reader = Controller(fn)
+    writer = Controller(fn, shared=reader)
+    assert reader.get_all_authors() == []
+    epoch = reader.cache.epoch
+    book = Book(None, "Title", 2000, 1, datetime.date(2020, 1, 1), "", "")
+    book.authors = writer.make_book_authors(book, ["Tolstoy"])
+    writer.add_book(book)
+    assert reader.get_all_authors() == ["Tolstoy"]
+    assert reader.cache.epoch == epoch
+    assert not writer.check_external_changes()
+
+    other = sqlite.connect(fn)
+    with other:
+        other.execute("insert into Authors(name) values ('Chekhov')")
+    assert reader.get_all_authors() == ["Tolstoy"]
+    assert writer.check_external_changes()
+    assert reader.get_all_authors() == ["Tolstoy", "Chekhov"]
+
+
+def test_add_relation(tmp_path: Path) -> None:
+    controller = Controller(str(tmp_path / "books.sqlite"))
+    notified: List[Set[int]] = []
+    controller.add_listener(notified.append)
+    book = Book(None, "Title", 2000, 1, datetime.date(2020, 1, 1), "", "")
+    controller.add_book(book)
+    assert book.id is not None
+
+    # Nothing is committed, and the new author gets no id, if the block fails
+    (item,) = controller.make_book_authors(book, ["Tolstoy"])
+    try:
+        with controller.transaction():
+            controller.add_book_author(item)
+            raise KeyError()
+    except KeyError:
+        pass
+    assert item.id is None and item.author.id is None
+    assert controller.get_all_authors() == []
+    assert notified == [{book.id}]
+
+    controller.add_book_author(item)
+    assert controller.get_all_authors() == ["Tolstoy"]
+    assert [a.author.name for a in controller.get_books([book.id])[0].authors] == [
+        "Tolstoy"
+    ]
+    assert notified == [{book.id}, {book.id}]
+
+
+def test_view_plans(tmp_path: Path) -> None:
+    controller = Controller(str(tmp_path / "books.sqlite"))
+    controller.change_user("fran")
+    assert controller.user is not None
+    seeks = 0
+    for view in config.parse_config_files([]).views:
+        sql = view.query.format(user=controller.user.id)
+        for row in controller.db.execute(f"explain query plan {sql}"):
+            detail = row["detail"]
+            tables = ("Wishlists", "BookReaders", "BookOwners")
+            # Each book of the view looks up the rows of the user's relations
+            if "LEFT-JOIN" in detail and detail.split()[1] in tables:
+                assert "book=?" in detail, (view.name, detail)
+                seeks += 1
+    assert seeks > 0
+
+
+def test_sort_key() -> None:
+    values = ["b", 1999, None, "01/02/2020", "2019/12/31", -406, "A"]
+    assert sorted(values, key=sort_key) == [
+        None,
+        -406,
+        1999,
+        "2019/12/31",
+        "01/02/2020",
+        "A",
+        "b",
+    ]
+
+
+def test_row_filter_implies() -> None:
+    assert RowFilter("tols").implies(RowFilter("tol"))
+    assert RowFilter("war tolstoy").implies(RowFilter("tol"))
+    assert RowFilter("authors:tolstoy").implies(RowFilter("tol"))
+    assert RowFilter("^war authors:tol").implies(RowFilter("^war"))
+    assert not RowFilter("tol").implies(RowFilter("tols"))
+    assert not RowFilter("tolstoy").implies(RowFilter("authors:tol"))
+    assert not RowFilter("^war").implies(RowFilter("war"))
+    assert not RowFilter("^wars").implies(RowFilter("^war"))
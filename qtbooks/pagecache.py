@@ -0,0 +1,149 @@
+import hashlib
+import os
+import sqlite3 as sqlite
+import threading
+import time
+import zlib
+from pathlib import Path
+from typing import Iterator, Optional, Tuple
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def default_cache_file() -> Path:
+    cache_home = os.environ.get("XDG_CACHE_HOME") or "~/.cache"
+    return Path(cache_home).expanduser() / "qtbooks" / "pages.sqlite"
+
+
+class PageCache(object):
+    """Persistent cache of fetched pages, keyed by URL
+
+    Bodies are stored compressed and addressed by the hash of their contents, so
+    identical pages are only stored once. Pages fetched more than `ttl` seconds ago
+    are stale, but are kept until they are fetched again so they can still be read
+    offline. The least recently fetched pages are evicted when the stored bodies
+    exceed `max_size` bytes. Safe to use from several threads.
+    """
+
+    def __init__(
+        self,
+        fn: Optional[Path] = None,
+        ttl: float = 30 * 24 * 3600,
+        max_size: int = 256 * 2**20,
+    ) -> None:
+        fn = fn or default_cache_file()
+        fn.parent.mkdir(parents=True, exist_ok=True)
+        self.ttl = ttl
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.db = sqlite.connect(str(fn), check_same_thread=False)
+        with self.db:
+            self.db.execute(
+                "create table if not exists Bodies(hash TEXT PRIMARY KEY, size INTEGER, body BLOB)"
+            )
+            self.db.execute(
+                """create table if not exists Pages(
+                    url TEXT PRIMARY KEY, hash TEXT REFERENCES Bodies (hash), fetched REAL)"""
+            )
+            self.db.execute("create index if not exists PagesFetched on Pages(fetched)")
+        self.evict()
+
+    def get(self, url: str, any_age: bool = False) -> Optional[str]:
+        """Cached text of `url`, or None if it isn't cached or is stale
+
+        Stale pages are returned too when `any_age` is True.
+        """
+        min_fetched = 0.0 if any_age else time.time() - self.ttl
+        with self.lock:
+            row = self.db.execute(
+                """select body from Pages join Bodies on Pages.hash = Bodies.hash
+                where url = ? and fetched >= ?""",
+                [url, min_fetched],
+            ).fetchone()
+        if row is None:
+            return None
+        return zlib.decompress(row[0]).decode("utf-8")
+
+    def items(self) -> Iterator[Tuple[str, str]]:
+        """(url, text) of every cached page, stale or not"""
+        with self.lock:
+            urls = [url for url, in self.db.execute("select url from Pages")]
+        for url in urls:
+            if (text := self.get(url, any_age=True)) is not None:
+                yield url, text
+
+    def put(self, url: str, text: str) -> None:
+        data = text.encode("utf-8")
+        digest = hashlib.sha256(data).hexdigest()
+        with self.lock, self.db:
+            if (
+                self.db.execute("select 1 from Bodies where hash = ?", [digest]).fetchone()
+                is None
+            ):
+                body = zlib.compress(data)
+                self.db.execute(
+                    "insert into Bodies(hash, size, body) values (?, ?, ?)",
+                    [digest, len(body), body],
+                )
+            self.db.execute(
+                "insert or replace into Pages(url, hash, fetched) values (?, ?, ?)",
+                [url, digest, time.time()],
+            )
+            self._evict_size()
+
+    def evict(self) -> None:
+        """Drops the unused bodies and the pages over the size limit"""
+        with self.lock, self.db:
+            self._drop_orphans()
+            self._evict_size()
+
+    def _evict_size(self) -> None:
+        size = self.db.execute("select coalesce(sum(size), 0) from Bodies").fetchone()[0]
+        if size <= self.max_size:
+            return
+        logger.debug(f"Page cache over size limit ({size} bytes), evicting")
+        # A body is only freed with the last page that has it
+        refs = dict(
+            self.db.execute("select hash, count(*) from Pages group by hash").fetchall()
+        )
+        for url, digest, body_size in self.db.execute(
+            """select url, Pages.hash, size
+            from Pages join Bodies on Pages.hash = Bodies.hash order by fetched"""
+        ).fetchall():
+            self.db.execute("delete from Pages where url = ?", [url])
+            refs[digest] -= 1
+            if refs[digest] > 0:
+                continue
+            size -= body_size
+            if size <= self.max_size:
+                break
+        self._drop_orphans()
+
+    def _drop_orphans(self) -> None:
+        self.db.execute("delete from Bodies where hash not in (select hash from Pages)")
+
+
+def test_page_cache(tmp_path: Path) -> None:
+    fn = tmp_path / "pages.sqlite"
+    cache = PageCache(fn, ttl=60)
+    shared, other = os.urandom(2000).hex(), os.urandom(1000).hex()
+    for i, (url, text) in enumerate([("a", shared), ("b", shared), ("c", other)]):
+        cache.put(url, text)
+        with cache.db:
+            cache.db.execute("update Pages set fetched = ? where url = ?", [i, url])
+
+    # Stale pages survive reopening the cache, for offline use
+    cache = PageCache(fn, ttl=60)
+    assert cache.get("a") is None
+    assert cache.get("a", any_age=True) == shared
+
+    # Evicting "a" alone frees nothing, as "b" still has its body
+    sizes = dict(cache.db.execute("select hash, size from Bodies").fetchall())
+    cache.max_size = min(sizes.values())
+    cache.evict()
+    assert [url for url, _ in cache.items()] == ["c"]
+    assert cache.db.execute("select sum(size) from Bodies").fetchone()[0] <= (
+        cache.max_size
+    )
@@ -0,0 +1,62 @@
+import time
+from pathlib import Path
+from typing import List, Optional, Tuple
+
+import click
+
+from qtbooks import extract
+from qtbooks.pagecache import PageCache
+
+
+def _parse_all(parse, pages: List[Tuple[str, str]]):
+    results = []
+    start = time.perf_counter()
+    for url, text in pages:
+        try:
+            results.append(parse(text, url))
+        except Exception as e:
+            results.append(type(e))
+    return results, time.perf_counter() - start
+
+
+@click.command()
+@click.option(
+    "-d",
+    "--pages-dir",
+    type=click.Path(exists=True, file_okay=False),
+    help="Directory of saved goodreads pages (*.html), the page cache by default",
+)
+@click.option("-r", "--repeat", type=int, default=1, help="Times each page is parsed")
+def compare(pages_dir: Optional[str], repeat: int) -> None:
+    """Checks that extract.parse_page gives the same results as the full
+    BeautifulSoup parser, and times both"""
+    if pages_dir is not None:
+        pages = [
+            (str(fn), fn.read_text()) for fn in sorted(Path(pages_dir).glob("*.html"))
+        ]
+    else:
+        pages = list(PageCache().items())
+    if len(pages) == 0:
+        raise click.ClickException("No pages to compare")
+    pages = pages * repeat
+
+    soup, soup_time = _parse_all(extract.parse_page_soup, pages)
+    fast, fast_time = _parse_all(extract.parse_page, pages)
+
+    mismatches = 0
+    for (url, _), expected, result in zip(pages, soup, fast):
+        if expected != result:
+            mismatches += 1
+            print(f"Mismatch in {url}:\n  soup: {expected}\n  fast: {result}")
+
+    print(f"Parsed {len(pages)} pages")
+    for name, elapsed in [("BeautifulSoup", soup_time), ("XPath", fast_time)]:
+        per_page = elapsed / len(pages) * 1000
+        print(f"{name + ':':14} {elapsed:.3f}s ({per_page:.2f} ms/page)")
+    print(f"Speedup:       {soup_time / fast_time:.1f}x")
+    if mismatches:
+        raise click.ClickException(f"{mismatches} pages differ")
+
+
+if __name__ == "__main__":
+    compare()
@@ -1,11 +1,12 @@
 import traceback
 import csv
-from datetime import datetime
 from typing import Optional
 
 import click
 
-from qtbooks import model, extract
+from qtbooks import model, goodreads
+from qtbooks.fetch import Fetcher
+from qtbooks.pagecache import PageCache
 
 
 @click.command()
@@ -20,63 +21,96 @@ from qtbooks import model, extract
 )
 @click.option("-u", "--user", type=str, required=True)
 @click.option("--out-csv", type=click.Path(dir_okay=False, writable=True))
+@click.option("--offline", is_flag=True, help="Only parse already cached pages")
+@click.option("--no-cache", is_flag=True, help="Don't use the page cache")
+@click.option(
+    "--retry-failed", is_flag=True, help="Retry the entries that failed in earlier runs"
+)
+@click.option(
+    "--batch-size", type=int, default=50, help="Entries committed at a time"
+)
+@click.option(
+    "--from-csv",
+    is_flag=True,
+    help="Build the books from the CSV columns, without fetching their pages",
+)
+@click.option(
+    "--enrich-genres",
+    is_flag=True,
+    help="Add the genres from the goodreads pages of the imported books",
+)
+@click.option(
+    "--lockfile",
+    is_flag=True,
+    help="Use the legacy lockfile, for databases in network or synced folders",
+)
 def import_books(
-    output_db: str, input_csv: str, user: str, out_csv: Optional[str]
+    output_db: str,
+    input_csv: str,
+    user: str,
+    out_csv: Optional[str],
+    offline: bool,
+    no_cache: bool,
+    retry_failed: bool,
+    batch_size: int,
+    from_csv: bool,
+    enrich_genres: bool,
+    lockfile: bool,
 ) -> None:
-    controller = model.Controller(output_db)
-    controller.change_user(user)
-    assert controller.user is not None  # mypy hint
-
-    with open(input_csv) as f:
-        library = list(csv.reader(f, delimiter=","))
-
-    lib = [{key: value for key, value in zip(library[0], row)} for row in library[1:]]
-
-    gr_failed = []
-    import_failed = []
-    for entry in lib:
-        try:
-            book = extract.import_book(
-                f"https://goodreads.com/book/show/{entry['Book Id']}", controller
-            )
-        except ConnectionError as e:
-            print(f"Failed to obtain goodreads page for book {entry['Title']}")
-            gr_failed.append(entry)
-            continue
-        except Exception as e:
-            print(f"Book {entry['Title']} couldn't be imported")
-            print(traceback.format_exc())
-            import_failed.append(entry)
-            continue
+    """Imports a goodreads library export
 
-        if entry["Exclusive Shelf"] == "read":
-            date = datetime.strptime(
-                entry["Date Read"] or entry["Date Added"], "%Y/%m/%d"
-            )
+    Progress is saved in the output database, so an interrupted import continues
+    where it stopped when run again. Books imported --from-csv have no genres, which
+    can be added later with --enrich-genres.
+    """
+    controller = model.Controller(output_db, lockfile)
+    if controller.readonly:
+        raise click.ClickException(f"Database {output_db} is in use")
+    try:
+        controller.change_user(user)
 
-            book.readings.append(
-                model.BookReader(
-                    None, controller.user, book, date, date, True, False, 0, ""
-                )
-            )
-        elif entry["Exclusive Shelf"] == "to-read":
-            book.wishlists.append(model.Wishlist(None, controller.user, book))
-        else:
-            print(f"Book {entry['Title']} wasn't read or wtr")
-            print(entry)
+        header, lib = goodreads.read_library(input_csv)
+        fetcher = Fetcher(cache=None if no_cache else PageCache(), offline=offline)
+        job = goodreads.ImportJob(
+            controller, lib, fetcher, batch_size, scrape=not from_csv
+        )
+        done = job.counts().get(goodreads.DONE, 0)
+        if done:
+            print(f"Resuming import, {done} entries already imported")
 
-        controller.add_book(book)
-        print(f"Imported {entry['Title']}")
+        for entry, status, error in job.run(retry_failed, on_batch=print):
+            if status == goodreads.DONE:
+                print(f"Imported {entry['Title']}")
+            elif status == goodreads.EXISTS:
+                print(f"Book {entry['Title']} already exists")
+            elif status == goodreads.FETCH_FAILED:
+                print(f"Failed to obtain goodreads page for book {entry['Title']}")
+            else:
+                assert error is not None  # mypy hint
+                print(f"Book {entry['Title']} couldn't be imported")
+                traceback.print_exception(type(error), error, error.__traceback__)
 
-    controller.release_lock()
+        if enrich_genres:
+            for entry, error in job.enrich(on_batch=print):
+                if error is not None:
+                    print(f"Failed to get the genres of book {entry['Title']}: {error}")
+    except KeyboardInterrupt:
+        print("Import interrupted, run again to resume it")
+        return
+    finally:
+        controller.release_lock()
 
+    import_failed = job.entries(goodreads.FAILED)
+    gr_failed = job.entries(goodreads.FETCH_FAILED)
     print(f"Failed to import: {[entry['Title'] for entry in import_failed]}")
     print(f"Failed to get goodreads page: {[entry['Title'] for entry in gr_failed]}")
     if out_csv is not None:
         with open(out_csv, "w") as f:
             csv_writer = csv.writer(f, delimiter=",")
-            csv_writer.writerow(library[0])
-            csv_writer.writerows(entry.values() for entry in gr_failed)
+            csv_writer.writerow(header)
+            csv_writer.writerows(
+                [entry.get(key, "") for key in header] for entry in gr_failed
+            )
 
 
 if __name__ == "__main__":